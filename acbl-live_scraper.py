@@ -16,87 +16,885 @@ This is only working for pairs and not team games and the tag on the ACBL websit
 
 import scrapy
 from scrapy.crawler import CrawlerProcess
-import re
+from scrapy import signals
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import defer, threads
+from twisted.internet.error import DNSLookupError, TimeoutError, TCPTimedOutError
 import json
-import mariadb
+import re
+try:
+    import mariadb
+except ImportError:
+    #only the mariadb backend needs it
+    mariadb = None
 import os
-import pandas as pd
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import random
 import numpy as np
 import sys
+import queue
+import threading
+import time
+import gzip
+import hashlib
+import socket
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from bridge_hands import encode_deals, deal_strings, parse_deal_strings, parse_double_dummy, parse_par, hand_features, DD_COLUMNS, PAR_COLUMNS, SEATS, SHAPE_CLASSES
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DATA_MARKER = b'var data ='
+json_decoder = json.JSONDecoder()
+
+def extract_game_data(body):
+    '''Finds the embedded var data json in the raw page bytes and decodes just that value.
+    Returns (data, payload) where payload is the json bytes, or (None, None) when the page has no data'''
+    start = body.find(DATA_MARKER)
+    if start == -1:
+        return None, None
+    start += len(DATA_MARKER)
+    end = body.find(b'</script>', start)
+    if end == -1:
+        end = len(body)
+    payload = body[start:end].strip()
+    if payload.endswith(b';'):
+        payload = payload[:-1].rstrip()
+
+    if orjson is not None:
+        try:
+            return orjson.loads(payload), payload
+        except orjson.JSONDecodeError:
+            #more script after the data, fall through and let raw_decode find where the value ends
+            pass
+    text = payload.decode('utf-8')
+    data, value_end = json_decoder.raw_decode(text)
+    return data, text[:value_end].encode('utf-8')
+
+def load_payload(payload):
+    #decode a payload that is exactly one json value, like the ones kept in the archive
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+def parse_game_page(body, deal_format='rows'):
+    '''Extracts and normalizes one result page, runs in the spider process or in a parse pool worker.
+    Returns (game_id, payload, tables, timings), timings has the seconds spent in extract and normalize,
+    game_id is None when the page has no data'''
+    timings = {}
+    stage_start = time.perf_counter()
+    data, payload = extract_game_data(body)
+    timings['extract'] = time.perf_counter() - stage_start
+    if data is None:
+        return None, None, None, timings
+    stage_start = time.perf_counter()
+    tables = normalize_game(data, deal_format=deal_format)
+    add_content_hash(tables, payload)
+    timings['normalize'] = time.perf_counter() - stage_start
+    return int(data.get('id')), payload, tables, timings
+
+def add_content_hash(tables, payload):
+    #sha256 of the payload, the same hash the RawArchive files it under, a correction to the game changes it
+    game_id = tables['game_data'].data['game_id'][0]
+    tables['game_hash_data'].append(game_id, hashlib.sha256(payload).hexdigest(), datetime.now().replace(microsecond=0))
+
+def deferred_from_future(future):
+    #fires on the reactor thread once a concurrent future finishes
+    #reactor is imported late so scrapy gets to install the asyncio reactor first
+    from twisted.internet import reactor
+    d = defer.Deferred()
+    def done(future):
+        if future.exception() is not None:
+            reactor.callFromThread(d.errback, future.exception())
+        else:
+            reactor.callFromThread(d.callback, future.result())
+    future.add_done_callback(done)
+    return d
+
+
+def atomic_write(path, data, replace=True):
+    '''Writes data (bytes, a buffer or str) to a temporary file next to path and renames it into place, so a crash or a
+    reader never sees half a file. The temporary name carries the process and thread so writers never share one.
+    With replace=False the temporary path is returned for the caller to rename along with others'''
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w' if isinstance(data, str) else 'wb') as file:
+        file.write(data)
+    if not replace:
+        return tmp_path
+    os.replace(tmp_path, path)
+    return path
+
+
+class RawArchive():
+    '''Content addressed store of the extracted var data payloads so games can be rebuilt without the website.
+    Payloads are compressed (zstd when zstandard is installed, gzip otherwise) under objects/<hash[:2]>/<hash>
+    and refs/<game_id> holds the hash of the latest payload for that game'''
+
+    def __init__(self, root='archive'):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'refs'), exist_ok=True)
+
+    def object_path(self, digest, extension):
+        return os.path.join(self.root, 'objects', digest[:2], digest + extension)
+
+    def put(self, game_id, payload):
+        digest = hashlib.sha256(payload).hexdigest()
+        if not (os.path.exists(self.object_path(digest, '.json.zst')) or os.path.exists(self.object_path(digest, '.json.gz'))):
+            os.makedirs(os.path.dirname(self.object_path(digest, '')), exist_ok=True)
+            if zstandard is not None:
+                atomic_write(self.object_path(digest, '.json.zst'), zstandard.ZstdCompressor(level=10).compress(payload))
+            else:
+                atomic_write(self.object_path(digest, '.json.gz'), gzip.compress(payload))
+        atomic_write(os.path.join(self.root, 'refs', str(game_id)), digest.encode('ascii'))
+        return digest
+
+    def get_hash(self, game_id):
+        ref_path = os.path.join(self.root, 'refs', str(game_id))
+        if not os.path.exists(ref_path):
+            return None
+        with open(ref_path, 'r') as file:
+            return file.read().strip()
+
+    def get(self, game_id):
+        digest = self.get_hash(game_id)
+        if digest is None:
+            return None
+        zst_path = self.object_path(digest, '.json.zst')
+        if os.path.exists(zst_path):
+            if zstandard is None:
+                raise RuntimeError(f'game {game_id} is archived with zstd, install zstandard to read it')
+            with open(zst_path, 'rb') as file:
+                return zstandard.ZstdDecompressor().decompress(file.read())
+        with open(self.object_path(digest, '.json.gz'), 'rb') as file:
+            return gzip.decompress(file.read())
+
+    def game_ids(self):
+        return sorted(int(name) for name in os.listdir(os.path.join(self.root, 'refs')) if name.isdigit())
+
+
+#each replay worker process keeps its own connection
+replay_db = None
+
+def replay_worker_init(staging=False):
+    global replay_db
+    StorageBackend.staging = staging
+    replay_db = open_database()
+
+def replay_game(game_id):
+    payload = RawArchive(replay_db.archive_dir).get(game_id)
+    data = load_payload(payload)
+    tables = normalize_game(data, deal_format=replay_db.deal_format)
+    add_content_hash(tables, payload)
+    return game_id, replay_db.upload_game(tables)
+
+def replay_archive(archive_dir, workers=None):
+    '''Rebuilds the tables from every archived game with no network access, spread over worker processes'''
+    game_ids = RawArchive(archive_dir).game_ids()
+    print(f"Replaying {len(game_ids)} archived games")
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=replay_worker_init, initargs=(StorageBackend.staging,)) as pool:
+        for game_id, written in pool.map(replay_game, game_ids, chunksize=8):
+            if not written:
+                failed.append(game_id)
+    print(f"Replayed {len(game_ids) - len(failed)} games, {len(failed)} failed {failed}")
+    return failed
+
+
+#column order of every table as it is written to the database, also the insert order for a game
+TABLE_COLUMNS = {
+    'player_data': ('name', 'acbl_num', 'city', 'state', 'lifemaster', 'master_points', 'bbo_username', 'last_updated'),
+    'club_data': ('club_num', 'club_name', 'unit_num', 'district_num', 'manager_num', 'alias'),
+    'game_data': ('game_id', 'game_name', 'game_rating', 'club_num', 'game_type', 'scoring_method', 'start_date', 'end_date', 'session_cnt', 'section_cnt'),
+    'game_hash_data': ('game_id', 'content_hash', 'hashed_at'),
+    'section_data': ('section_id', 'game_id', 'session_id', 'section_name', 'hand_record', 'boards_per', 'round_count', 'pair_count'),
+    'hand_records_data': ('hand_id', 'hand_record', 'board', 'board_id_num', 'direction', 'spades', 'hearts', 'diamonds', 'clubs'),
+    'hand_deal_data': ('hand_id', 'hand_record', 'board', 'board_id_num', 'deal'),
+    'hand_possibility_data': ('hand_id', 'hand_record', 'board', 'board_id_num', 'dealer', 'vulnerability', 'double_dummy_ew', 'double_dummy_ns', 'par'),
+    'hand_dd_data': ('hand_id',) + DD_COLUMNS + PAR_COLUMNS,
+    'hand_feature_data': ('hand_id', 'seat', 'hcp', 'spades', 'hearts', 'diamonds', 'clubs', 'shape', 'shape_class', 'ltc', 'side_hcp', 'side_ltc'),
+    'hand_results_data': ('result_id', 'session_id', 'hand_record', 'section_id', 'board_id', 'board_num', 'round_num', 'table_num', 'ns_pair', 'ew_pair', 'ns_score', 'ew_score', 'contract', 'declarer', 'ew_match_points', 'ns_match_points', 'opening_lead', 'result', 'tricks_taken'),
+    'pair_results_data': ('pair_id_num', 'session_id', 'section_id', 'acbl_num', 'pair', 'score', 'percentage', 'mp_earned', 'direction'),
+    'strat_result_summary_data': ('strat_id', 'pair_id_num', 'strat_num', 'rank', 'strat_type'),
+}
 
+#tables that are upserted rather than inserted
+UPLOAD_OPTIONS = {
+    'player_data': {'prim_key': 'acbl_num', 'date_check': True},
+    'game_hash_data': {'prim_key': 'game_id'},
+}
 
+#result tables a corrected game is diffed on, with the columns that key a row
+DIFF_KEYS = {
+    'hand_results_data': ('result_id',),
+    'pair_results_data': ('pair_id_num', 'acbl_num'),
+    'strat_result_summary_data': ('strat_id',),
+}
 
-class DatabasePipeline():
+#player aggregates kept current by every ingest from the new game's pair_results_data rows.
+#columns are the key, then sums that are added to, then dates kept as the latest or earliest seen
+PLAYER_AGGREGATES = {
+    'player_month_data': {'keys': ('acbl_num', 'month'), 'sums': ('sessions', 'percentage_sum', 'mp_earned'), 'latest': (), 'earliest': ()},
+    'player_partner_data': {'keys': ('acbl_num', 'partner_num'), 'sums': ('sessions', 'percentage_sum', 'mp_earned'), 'latest': ('last_played',), 'earliest': ()},
+    'player_club_data': {'keys': ('acbl_num', 'club_num'), 'sums': ('sessions', 'percentage_sum', 'mp_earned'), 'latest': ('last_played',), 'earliest': ('first_played',)},
+}
 
-    table_list = ('player_data','club_data','game_data','section_data','hand_records_data','hand_possibility_data','hand_results_data','pair_results_data','strat_result_summary_data')
-    
-    def __init__(self):
-        data_file = 'db.json'
-        data_folder = 'settings'
-        app_folder = 'acblclub-scrap'
-        file_path = os.path.join(data_folder,data_file) 
-        with open(file_path,'r') as file:
-            self.cred_data = json.load(file)
-        self.cur = None
-    #allow flexibilty on the database type to be allowed to do this at work and test environment
-        if self.cred_data['system'] == 'mariadb':
-            try:
-                self.conn = mariadb.connect(
-                    user=self.cred_data['user'],
-                    password=self.cred_data['password'],
-                    host=self.cred_data['host'],
-                    port=self.cred_data['port'],
-                    database=self.cred_data['database']
-            )
-                print("link to database was created")
-                self.cur = self.conn.cursor()
-            except mariadb.Error as e:
-                print(f"Error connecting to MariaDB")
-        
-        for table in self.table_list:
-            if self.table_exists(table):
+def player_aggregates(club_num, game_date, added=(), removed=()):
+    '''Increments for the PLAYER_AGGREGATES tables from the pair_results_data rows of one game, {table: rows}.
+    removed rows are subtracted, so a corrected game passes its old rows as removed and its new rows as added.
+    Players with no acbl number are left out'''
+    month = game_date.replace(day=1)
+    totals = {table_name: {} for table_name in PLAYER_AGGREGATES}
+
+    def add(table_name, key, sums):
+        current = totals[table_name].setdefault(key, [0, 0.0, 0.0])
+        for num, value in enumerate(sums):
+            current[num] += value
+
+    for rows, sign in ((added, 1), (removed, -1)):
+        pairs = {}
+        for row in rows:
+            if not row[3]:
                 continue
-            else:
+            #rounded the way pair_results_data stores them so a full rebuild gives the same sums
+            sums = (sign, sign * round(float(row[6] or 0), 2), sign * round(float(row[7] or 0), 2))
+            pairs.setdefault(row[0], []).append((row[3], sums))
+            add('player_month_data', (row[3], month), sums)
+            add('player_club_data', (row[3], club_num), sums)
+        for players in pairs.values():
+            for acbl_num, sums in players:
+                for partner_num, partner_sums in players:
+                    if partner_num != acbl_num:
+                        add('player_partner_data', (acbl_num, partner_num), sums)
+
+    aggregates = {}
+    for table_name, spec in PLAYER_AGGREGATES.items():
+        dates = (game_date,) * (len(spec['latest']) + len(spec['earliest']))
+        aggregates[table_name] = [key + tuple(round(value, 2) for value in sums) + dates for key, sums in totals[table_name].items()]
+    return aggregates
+
+
+class TableBuffer():
+    '''Column oriented rows for one table, one list per column'''
+
+    def __init__(self, table_name, columns=None):
+        self.table_name = table_name
+        self.columns = columns or TABLE_COLUMNS[table_name]
+        self.data = {column: [] for column in self.columns}
+        self.column_lists = [self.data[column] for column in self.columns]
+
+    def __len__(self):
+        return len(self.column_lists[0])
+
+    def append(self, *values):
+        for column_list, value in zip(self.column_lists, values):
+            column_list.append(value)
+
+    def rows(self):
+        return list(zip(*self.column_lists))
+
+    def to_frame(self):
+        #pandas is only imported when a DataFrame is asked for, the crawl never needs it
+        import pandas as pd
+        return pd.DataFrame(self.data, columns=self.columns)
+
+
+def add_hand_features(features_out, hand_ids, deals):
+    '''Fills hand_feature_data with one row per seat from the features of all the game's deals, worked out in one go.
+    A seat with a short hand record gets no row'''
+    features = hand_features(deals)
+    lengths = features['lengths']
+    shape_classes = np.array(SHAPE_CLASSES)[features['shape_class']]
+    for board_num, seat_num in zip(*np.nonzero(features['complete'])):
+        features_out.append(hand_ids[board_num], SEATS[seat_num], int(features['hcp'][board_num, seat_num]),
+                            *lengths[board_num, seat_num].tolist(), str(features['shape'][board_num, seat_num]),
+                            str(shape_classes[board_num, seat_num]), int(features['ltc'][board_num, seat_num]),
+                            int(features['side_hcp'][board_num, seat_num]), int(features['side_ltc'][board_num, seat_num]))
+
+
+def clean_suit(cards):
+    #remove spaces and turn 10 into T so every card is one character
+    if cards is None:
+        return None
+    return cards.replace('10', 'T').replace(' ', '')
+
+def blank_to_none(value):
+    return None if value == '' else value
+
+
+def normalize_game(data, deal_format='rows'):
+    '''Walks the game json once and fills a TableBuffer for each table.
+    deal_format picks how hands are stored, 'rows' is four rows per board in hand_records_data, 'compact' is one
+    52 character row per board in hand_deal_data and 'both' writes the two.
+    Returns a dict of table name to buffer in the order the tables are written'''
+    tables = {table_name: TableBuffer(table_name) for table_name in TABLE_COLUMNS}
+    players = tables['player_data']
+    #one row per player, a player in every session of the game is only written once
+    player_rows = {}
+    sections_out = tables['section_data']
+    hand_records_out = tables['hand_records_data']
+    hand_expect_out = tables['hand_possibility_data']
+    deals_out = tables['hand_deal_data']
+    dd_out = tables['hand_dd_data']
+    features_out = tables['hand_feature_data']
+    #holdings of every board, encoded together once the walk is done for the compact deals and the hand features
+    deal_suits = []
+    deal_hand_ids = []
+    hand_results_out = tables['hand_results_data']
+    pair_results_out = tables['pair_results_data']
+    strats_out = tables['strat_result_summary_data']
+
+    game_id = data['id']
+    sessions = data['sessions']
+    #used to make sure only the latest is updated
+    last_updated = datetime.strptime(sessions[0]['game_date'], "%Y-%m-%d %H:%M:%S").date()
+
+    club = data['club']
+    tables['club_data'].append(club['id'], club['name'], club['unit_no'], club['district_no'], club['manager_no'], club['alias'])
+
+    section_count = 0
+    for session in sessions:
+        section_count += int(session['number_of_sections'])
+        session_id = session['id']
+        hand_record_id = session['hand_record_id']
+        #hand records are only kept for pre dealt boards
+        keep_hands = hand_record_id is not None and hand_record_id != '' and hand_record_id != 'SHUFFLE'
+        sections = session['sections']
+
+        for section in sections:
+            section_id = section['id']
+            pair_summaries = section['pair_summaries']
+            sections_out.append(section_id, game_id, section['session_id'], section['name'], hand_record_id,
+                                section['boards_per_round'], section['number_of_rounds'], len(pair_summaries))
+            add_pair_direction = bool(pair_summaries and pair_summaries[0]['direction'])
+
+            for pair_summary in pair_summaries:
+                pair_direction = pair_summary['direction']
+                pair = pair_summary['pair_number'] + pair_direction if add_pair_direction else pair_summary['pair_number']
+                pair_summary_id = pair_summary['id']
+                score = pair_summary['score']
+                percentage = pair_summary['percentage'] if pair_summary['percentage'] is not None else 0
+                for player_num, player in enumerate(pair_summary['players']):
+                    #players with no acbl number can't be keyed in player_data
+                    if player['id_number']:
+                        player_rows[player['id_number']] = (player['name'], player['id_number'], player['city'], player['state'],
+                                                            player['lifemaster'] if player['lifemaster'] is not None else 0,
+                                                            float(player['mp_total']) if player['mp_total'] is not None else 0.0,
+                                                            player['bbo_username'], last_updated)
+                    mp = player['awards_score'][0]['total'] if len(player['awards_score']) > 0 else None
+                    #set default direction for the pair
+                    direction = None
+                    if add_pair_direction:
+                        if pair_direction == 'NS':
+                            direction = 'N' if player_num == 0 else 'S'
+                        else:
+                            direction = 'E' if player_num != 0 else 'W'
+                    pair_results_out.append(pair_summary_id, session_id, section_id, player['id_number'], pair, score, percentage, mp, direction)
+                for strat in pair_summary['strat_place']:
+                    strats_out.append(strat['id'], pair_summary_id, strat['strat_number'], strat['rank'], strat['type'])
+
+            if not keep_hands:
+                continue
+            for board in section['boards']:
+                board_num = board['board_number']
+                for result in board['board_results']:
+                    round_num = blank_to_none(result['round_number'])
+                    if round_num is None:
+                        continue
+                    if add_pair_direction:
+                        ns_pair = result['ns_pair'] + 'NS'
+                        ew_pair = result['ew_pair'] + 'EW'
+                    else:
+                        ns_pair = blank_to_none(result['ns_pair'])
+                        ew_pair = blank_to_none(result['ew_pair'])
+                    ns_score = blank_to_none(result['ns_score'])
+                    ew_score = blank_to_none(result['ew_score'])
+                    #should be some nulls in results when there are weird adjustments
+                    res = blank_to_none(result['result'])
+                    hand_results_out.append(result['id'], session_id, hand_record_id, section_id, result['board_id'], board_num,
+                                            round_num, blank_to_none(result['table_number']), ns_pair, ew_pair,
+                                            ns_score.replace('PASS', '0') if isinstance(ns_score, str) else ns_score,
+                                            ew_score.replace('PASS', '0') if isinstance(ew_score, str) else ew_score,
+                                            blank_to_none(result['contract']), blank_to_none(result['declarer']),
+                                            blank_to_none(result['ew_match_points']), blank_to_none(result['ns_match_points']),
+                                            blank_to_none(result['opening_lead']),
+                                            res.replace('=', '0') if isinstance(res, str) else res,
+                                            blank_to_none(result['tricks_taken']))
+
+        if not keep_hands:
+            continue
+        #board ids come from the first section's board results
+        board_ids = {}
+        if sections:
+            for board in sections[0]['boards']:
+                board_ids[board['board_number']] = board['id']
+        for hand in session['hand_records']:
+            hand_id = hand['id']
+            board = hand['board']
+            board_id_num = board_ids.get(board)
+            if board_id_num is None:
+                board_id_num = 0
+            if deal_format != 'compact':
+                for direction, seat in (('N', 'north'), ('S', 'south'), ('E', 'east'), ('W', 'west')):
+                    hand_records_out.append(hand_id, hand_record_id, board, board_id_num, direction,
+                                            clean_suit(hand[seat + '_spades']), clean_suit(hand[seat + '_hearts']),
+                                            clean_suit(hand[seat + '_diamonds']), clean_suit(hand[seat + '_clubs']))
+            if deal_format != 'rows':
+                deals_out.append(hand_id, hand_record_id, board, board_id_num, None)
+            deal_hand_ids.append(hand_id)
+            deal_suits.append([[clean_suit(hand[seat + suit]) or '' for suit in ('_spades', '_hearts', '_diamonds', '_clubs')]
+                               for seat in ('north', 'east', 'south', 'west')])
+            hand_expect_out.append(hand_id, hand_record_id, board, board_id_num, hand['dealer'], hand['vulnerability'],
+                                   hand['double_dummy_ew'], hand['double_dummy_ns'], hand['par'])
+            #typed copies of the double dummy and par strings
+            dd_out.append(hand_id, *parse_double_dummy(hand['double_dummy_ns'], hand['double_dummy_ew']), *parse_par(hand['par']))
+
+    for player_row in player_rows.values():
+        players.append(*player_row)
+
+    if deal_suits:
+        deals = encode_deals(deal_suits)
+        if deal_format != 'rows':
+            deals_out.data['deal'][:] = deal_strings(deals).tolist()
+        add_hand_features(features_out, deal_hand_ids, deals)
+
+    tables['game_data'].append(game_id, data['name'], data['rating'], data['club_id_number'], data['type'], data['board_scoring_method'],
+                               datetime.strptime(data['start_date'], "%m/%d/%Y").date(), datetime.strptime(data['end_date'], "%m/%d/%Y").date(),
+                               data['number_of_sessions'], section_count)
+
+    print("Normalized game..." + str(game_id))
+    return tables
+
+
+
+class PlayerCache():
+    '''Process wide LRU of acbl_num -> (last_updated, the other columns) for players already written.
+    Players that are not newer than what was written, or whose columns other than last_updated are all the same,
+    are not sent again'''
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def changed(self, columns, rows):
+        #newest row per player first, then drop the ones the cache says are unchanged
+        key_col, date_col = columns.index('acbl_num'), columns.index('last_updated')
+        newest = {}
+        for row in rows:
+            current = newest.get(row[key_col])
+            if current is None or row[date_col] > current[date_col]:
+                newest[row[key_col]] = row
+        changed_rows = []
+        with self.lock:
+            for acbl_num, row in newest.items():
+                cached = self.entries.get(acbl_num)
+                if cached is not None:
+                    self.entries.move_to_end(acbl_num)
+                    if row[date_col] <= cached[0] or self.details(row, date_col) == cached[1]:
+                        continue
+                changed_rows.append(row)
+        return changed_rows
+
+    def remember(self, columns, rows):
+        #only called once the rows are committed
+        key_col, date_col = columns.index('acbl_num'), columns.index('last_updated')
+        with self.lock:
+            for row in rows:
+                self.entries[row[key_col]] = (row[date_col], self.details(row, date_col))
+                self.entries.move_to_end(row[key_col])
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    @staticmethod
+    def details(row, date_col):
+        #every column but last_updated, a change to any of them is written
+        return row[:date_col] + row[date_col + 1:]
+
+player_cache = PlayerCache()
+
+
+#column definitions shared by the sql backends, the parquet backend takes its column types from here too
+TABLE_DEFINITIONS = {
+    'club_data': '(`club_num` int(7) NOT NULL,`club_name` varchar(45) NOT NULL,`unit_num` smallint(6) NOT NULL,`district_num` smallint(6) NOT NULL,`manager_num` int(10) DEFAULT NULL,`alias` varchar(10) DEFAULT NULL, PRIMARY KEY (`club_num`))',
+    'game_hash_data': '(`game_id` int(7) NOT NULL,`content_hash` char(64) NOT NULL,`hashed_at` datetime NOT NULL,PRIMARY KEY (`game_id`))',
+    'game_data': '(`game_id` int(7) NOT NULL,`game_name` varchar(90) DEFAULT NULL,`game_rating` tinyint(4) NOT NULL,`club_num` int(7) NOT NULL,`game_type` varchar(30) NOT NULL,`scoring_method` varchar(15) NOT NULL,`start_date` date NOT NULL,`end_date` date DEFAULT NULL,`session_cnt` tinyint(4) NOT NULL,`section_cnt` tinyint(4) NOT NULL, PRIMARY KEY (`game_id`))',
+    'hand_possibility_data': '(`hand_id` int(11) NOT NULL,`hand_record` varchar(10) NOT NULL,`board` tinyint(4) NOT NULL,`board_id_num` int(15) DEFAULT NULL,`dealer` varchar(1) NOT NULL,`vulnerability` varchar(10) NOT NULL,`double_dummy_ew` varchar(40) NOT NULL,`double_dummy_ns` varchar(45) NOT NULL,`par` varchar(40) NOT NULL,PRIMARY KEY (`hand_id`))',
+    'player_month_data': '(`acbl_num` int(10) NOT NULL,`month` date NOT NULL,`sessions` int(7) NOT NULL,`percentage_sum` decimal(10,2) NOT NULL,`mp_earned` decimal(8,2) NOT NULL,PRIMARY KEY (`acbl_num`,`month`))',
+    'player_partner_data': '(`acbl_num` int(10) NOT NULL,`partner_num` int(10) NOT NULL,`sessions` int(7) NOT NULL,`percentage_sum` decimal(10,2) NOT NULL,`mp_earned` decimal(8,2) NOT NULL,`last_played` date DEFAULT NULL,PRIMARY KEY (`acbl_num`,`partner_num`))',
+    'player_club_data': '(`acbl_num` int(10) NOT NULL,`club_num` int(7) NOT NULL,`sessions` int(7) NOT NULL,`percentage_sum` decimal(10,2) NOT NULL,`mp_earned` decimal(8,2) NOT NULL,`first_played` date DEFAULT NULL,`last_played` date DEFAULT NULL,PRIMARY KEY (`acbl_num`,`club_num`))',
+    'schema_version_data': '(`version` int(7) NOT NULL,`description` varchar(120) DEFAULT NULL,`applied_at` datetime DEFAULT NULL,PRIMARY KEY (`version`))',
+    'work_claim_data': '(`claim_key` varchar(40) NOT NULL,`owner` varchar(80) NOT NULL,`lease_until` datetime NOT NULL,`done` tinyint(1) NOT NULL DEFAULT 0,PRIMARY KEY (`claim_key`))',
+    'club_registry_data': '(`club_num` int(7) NOT NULL,`url` varchar(120) NOT NULL,`active` tinyint(1) NOT NULL DEFAULT 1,`last_polled` datetime DEFAULT NULL,`next_poll` datetime DEFAULT NULL,`idle_polls` smallint(6) NOT NULL DEFAULT 0,PRIMARY KEY (`club_num`))',
+    'club_watermark_data': '(`club_num` int(7) NOT NULL,`last_game_id` int(7) NOT NULL,`last_game_date` datetime NOT NULL,PRIMARY KEY (`club_num`))',
+    'hand_deal_data': '(`hand_id` int(11) NOT NULL,`hand_record` varchar(10) NOT NULL,`board` tinyint(4) NOT NULL,`board_id_num` int(15) DEFAULT NULL,`deal` char(52) NOT NULL,PRIMARY KEY (`hand_id`))',
+    #tricks per declarer and strain, dd_n_c is north declaring clubs, and the par contract split into its parts
+    'hand_dd_data': '(`hand_id` int(11) NOT NULL,' + ''.join(f'`{column}` tinyint(4) DEFAULT NULL,' for column in DD_COLUMNS) + '`par_level` tinyint(4) DEFAULT NULL,`par_strain` char(1) DEFAULT NULL,`par_doubled` varchar(2) DEFAULT NULL,`par_declarer` varchar(2) DEFAULT NULL,`par_score` smallint(6) DEFAULT NULL,PRIMARY KEY (`hand_id`))',
+    'hand_records_data': '(`hand_id` int(11) NOT NULL,`hand_record` varchar(10) NOT NULL,`board` tinyint(4) NOT NULL,`board_id_num` int(15) DEFAULT NULL,`direction` varchar(1) NOT NULL,`spades` varchar(13) NOT NULL,`hearts` varchar(13) NOT NULL,`diamonds` varchar(13) NOT NULL,`clubs` varchar(13) NOT NULL,PRIMARY KEY (`hand_id`,`direction`))',
+    'hand_feature_data': '(`hand_id` int(11) NOT NULL,`seat` char(1) NOT NULL,`hcp` tinyint(4) NOT NULL,`spades` tinyint(4) NOT NULL,`hearts` tinyint(4) NOT NULL,`diamonds` tinyint(4) NOT NULL,`clubs` tinyint(4) NOT NULL,`shape` varchar(11) NOT NULL,`shape_class` varchar(13) NOT NULL,`ltc` tinyint(4) NOT NULL,`side_hcp` tinyint(4) NOT NULL,`side_ltc` tinyint(4) NOT NULL,PRIMARY KEY (`hand_id`,`seat`))',
+    'hand_results_data': '(`result_id` int(15) NOT NULL,`session_id` int(7) NOT NULL,`hand_record` varchar(9) NOT NULL,`section_id` int(7) NOT NULL,`board_id` int(15) NOT NULL,`board_num` tinyint(4) NOT NULL,`round_num` tinyint(4) NOT NULL,`table_num` tinyint(4) NOT NULL,`ns_pair` varchar(5) NOT NULL,`ew_pair` varchar(5) NOT NULL,`ns_score` int(6) NOT NULL,`ew_score` int(6) NOT NULL,`contract` varchar(10) DEFAULT NULL,`declarer` varchar(1) DEFAULT NULL,`ew_match_points` decimal(6,2) NOT NULL,`ns_match_points` decimal(6,2) NOT NULL,`opening_lead` varchar(4) DEFAULT NULL,`result` tinyint(4) DEFAULT NULL,`tricks_taken` tinyint(4) DEFAULT NULL,PRIMARY KEY (`result_id`))',
+    'pair_results_data': '(pair_id_num int(15) NOT NULL,session_id int(7) NOT NULL,section_id int(7) NOT NULL,acbl_num int(10) NOT NULL,pair varchar(6) NOT NULL,score decimal(6,2) NOT NULL,percentage decimal(6,2) NOT NULL,mp_earned decimal(5,2) DEFAULT NULL,direction varchar(2) DEFAULT NULL,PRIMARY KEY (pair_id_num,acbl_num))',
+    'player_data': '(`acbl_num` int(10) NOT NULL,`name` varchar(25) DEFAULT NULL,`city` varchar(20) DEFAULT NULL,`state` varchar(20) DEFAULT NULL,`master_points` float DEFAULT NULL,`bbo_username` varchar(20) DEFAULT NULL,`lifemaster` tinyint(1) NOT NULL,`last_updated` date NOT NULL,PRIMARY KEY (`acbl_num`))',
+    'section_data': '(`section_id` int(7) NOT NULL,`section_name` varchar(10) DEFAULT NULL,`game_id` int(7) NOT NULL,`session_id` int(7) NOT NULL,`hand_record` varchar(10) DEFAULT NULL,`boards_per` tinyint(4) DEFAULT NULL,`round_count` tinyint(4) DEFAULT NULL,`pair_count` smallint(6) DEFAULT NULL, PRIMARY KEY (`section_id`))',
+    'strat_result_summary_data': '(`strat_id` int(15) NOT NULL,`pair_id_num` int(15) NOT NULL,`strat_num` smallint(6) NOT NULL,`rank` tinyint(4) DEFAULT NULL,`strat_type` varchar(10) DEFAULT NULL,PRIMARY KEY (`strat_id`))',
+}
+
+#secondary indexes on the columns the ingest and analytics join and filter by, built with the table
+TABLE_INDEXES = {
+    'game_data': (('club_num', 'start_date'),),
+    'section_data': (('game_id',),),
+    'hand_results_data': (('section_id', 'board_id'),),
+    'hand_feature_data': (('shape_class', 'hcp'), ('side_hcp',)),
+    'pair_results_data': (('acbl_num',), ('section_id',)),
+    'strat_result_summary_data': (('pair_id_num',),),
+}
+
+#result tables that can be range partitioned by year, on the leading key column which the website hands out in date order
+PARTITIONED_TABLES = {
+    'hand_results_data': 'result_id',
+    'pair_results_data': 'pair_id_num',
+    'strat_result_summary_data': 'strat_id',
+}
+
+#schema changes to existing databases in order, (version, description, backend method), applied versions are kept in
+#schema_version_data. Missing tables are built whole before these run so a migration only has to fix existing tables
+SCHEMA_MIGRATIONS = [
+    (1, 'primary keys as in TABLE_DEFINITIONS', 'migrate_primary_keys'),
+    (2, 'secondary indexes from TABLE_INDEXES', 'migrate_indexes'),
+]
+
+PRIMARY_KEY = re.compile(r'PRIMARY KEY \(([^)]*)\)')
+
+def primary_key(table_name):
+    return tuple(column.strip(' `') for column in PRIMARY_KEY.search(TABLE_DEFINITIONS[table_name]).group(1).split(','))
+
+COLUMN_TYPE = re.compile(r'`?(\w+)`?\s+(int|tinyint|smallint|bigint|decimal|float|double|datetime|date|varchar|char)\b')
+
+NOT_NULL_COLUMN = re.compile(r'`?(\w+)`?\s+\w+(?:\([\d,]+\))?\s+NOT NULL')
+
+def column_types(table_name):
+    #column name -> sql type name from TABLE_DEFINITIONS
+    return dict(COLUMN_TYPE.findall(TABLE_DEFINITIONS[table_name]))
+
+def comparable_rows(table_name, columns, rows):
+    '''rows with every value as the database keeps it, so rows read back compare equal to freshly parsed rows.
+    A missing value in a NOT NULL column becomes 0 or '' the way mariadb's INSERT IGNORE stores it'''
+    sql_types = column_types(table_name)
+    not_null = set(NOT_NULL_COLUMN.findall(TABLE_DEFINITIONS[table_name]))
+    converters = []
+    for column in columns:
+        sql_type = sql_types.get(column, 'varchar')
+        if sql_type in ('int', 'tinyint', 'smallint', 'bigint'):
+            convert, default = int, 0
+        elif sql_type == 'decimal':
+            convert, default = lambda value: round(float(value), 2), 0.0
+        elif sql_type in ('float', 'double'):
+            convert, default = float, 0.0
+        elif sql_type in ('date', 'datetime'):
+            convert, default = lambda value: value, None
+        else:
+            convert, default = str, ''
+        converters.append((convert, default if column in not_null else None))
+    return [tuple(default if value is None else convert(value) for (convert, default), value in zip(converters, row)) for row in rows]
+
+
+class StorageBackend():
+    '''What the crawl, the writers and the replay need from storage. open_database picks the implementation from the
+    system key in db.json, mariadb and sqlite are sql databases and parquet writes partitioned files for analysis'''
+
+    #set for --rebuild, every connection then writes to staging copies which are swapped in at the end
+    staging = False
+    staging_suffix = '_staging'
+
+    table_list = ('player_data','club_data','game_data','game_hash_data','section_data','hand_records_data','hand_deal_data','hand_possibility_data','hand_dd_data','hand_feature_data','hand_results_data','pair_results_data','strat_result_summary_data','club_watermark_data','player_month_data','player_partner_data','player_club_data')
+    #crawl configuration rather than results, never staged or swapped on a rebuild
+    config_table_list = ('club_registry_data','work_claim_data','schema_version_data')
+
+    def __init__(self, cred_data):
+        self.cred_data = cred_data
+        #rows sent per executemany call, can be overridden in db.json
+        self.chunk_size = int(self.cred_data.get('chunk_size', 1000))
+        #rows, compact or both, see normalize_game
+        self.deal_format = self.cred_data.get('deal_format', 'rows')
+        #raw payloads are archived here for offline replay, an empty value turns the archive off
+        self.archive_dir = self.cred_data.get('archive_dir', 'archive')
+        self.player_cache = player_cache
+        if 'player_cache_size' in self.cred_data:
+            self.player_cache.size = int(self.cred_data['player_cache_size'])
+        #stats key -> value for the writes since the last take_metrics, see record_upload
+        self.metrics = {}
+
+    def record_upload(self, table_name, rows, seconds, duplicates=None):
+        #rows sent and time spent per table, duplicates is how many rows INSERT IGNORE skipped when the driver says
+        self.metrics[f'acbl/upload_rows/{table_name}'] = self.metrics.get(f'acbl/upload_rows/{table_name}', 0) + rows
+        self.metrics[f'acbl/upload_seconds/{table_name}'] = self.metrics.get(f'acbl/upload_seconds/{table_name}', 0) + seconds
+        if duplicates:
+            self.metrics[f'acbl/duplicate_rows/{table_name}'] = self.metrics.get(f'acbl/duplicate_rows/{table_name}', 0) + duplicates
+
+    def record_error(self, error):
+        key = f'acbl/db_errors/{type(error).__name__}'
+        self.metrics[key] = self.metrics.get(key, 0) + 1
+
+    def take_metrics(self):
+        metrics, self.metrics = self.metrics, {}
+        return metrics
+
+    def table(self, table_name):
+        #the name actually written to, the staging copy during a rebuild
+        if self.staging:
+            return table_name + self.staging_suffix
+        return table_name
+
+    def upload_df_to_database(self, df, table_name, prim_key=None,date_check=False, chunk_size=None, commit=True):
+        #object dtype hands python types to the connector and NaN becomes NULL
+        rows = list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+        self.upload_rows(table_name, df.columns, rows, prim_key=prim_key, date_check=date_check, chunk_size=chunk_size, commit=commit)
+
+    def upload_game(self, tables, watermark=None):
+        '''writes every table for a game in one transaction, tables is the dict of TableBuffer from normalize_game.
+        watermark is an optional (club_num, game_id, listing_date) moved forward in the same transaction.
+        If any table fails the whole game is rolled back so a partial game never lands in game_data'''
+        table_name = None
+        player_rows = []
+        new_game = True
+        try:
+            for table_name, buffer in tables.items():
+                rows = buffer.rows()
+                if table_name == 'player_data':
+                    rows = player_rows = self.player_cache.changed(buffer.columns, rows)
+                if len(rows) == 0:
+                    continue
+                written = self.upload_rows(table_name, buffer.columns, rows, commit=False, **UPLOAD_OPTIONS.get(table_name, {}))
+                if table_name == 'game_data':
+                    #a game that was already stored has been counted in the player aggregates
+                    new_game = written != 0
+            if new_game:
+                table_name = 'player aggregates'
+                game = tables['game_data'].data
+                self.add_player_aggregates(player_aggregates(game['club_num'][0], game['start_date'][0], added=tables['pair_results_data'].rows()))
+            if watermark:
+                table_name = 'club_watermark_data'
+                self.update_watermark(*watermark, commit=False)
+            self.commit()
+        except Exception as e:
+            print(f"Rolling back game, {table_name} failed: {e}")
+            self.record_error(e)
+            self.rollback()
+            return False
+        if player_rows:
+            self.player_cache.remember(TABLE_COLUMNS['player_data'], player_rows)
+        return True
+
+    def update_game(self, tables, watermark=None):
+        '''writes a game that is already stored but whose content hash changed, backends that can't diff rewrite it whole'''
+        return self.upload_game(tables, watermark=watermark)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+    #sql backends can lease work through work_claim_data
+    supports_claims = True
+
+    def compact(self):
+        #only the file backends have anything to merge after a run
+        pass
+
+    #every backend implements these
+    def upload_rows(self, table_name, columns, rows, prim_key=None,date_check=False, chunk_size=None, commit=True):
+        raise NotImplementedError
+
+    def purge_db_contents(self):
+        raise NotImplementedError
+
+    def get_game_list(self, club_nums=None):
+        raise NotImplementedError
+
+    def get_content_hashes(self, since):
+        raise NotImplementedError
+
+    def get_watermarks(self):
+        raise NotImplementedError
+
+    def update_watermark(self, club_num, game_id, game_date, commit=True):
+        raise NotImplementedError
+
+    def register_clubs(self, clubs):
+        raise NotImplementedError
+
+    def get_club_registry(self):
+        raise NotImplementedError
+
+    def record_poll(self, club_num, polled, next_poll, idle_polls):
+        raise NotImplementedError
+
+    def claim_work(self, keys, owner, lease_until, now):
+        raise NotImplementedError
+
+    def finish_work(self, keys, owner):
+        raise NotImplementedError
+
+    def release_work(self, keys, owner):
+        raise NotImplementedError
+
+    def get_game_dates(self, since):
+        raise NotImplementedError
+
+    def add_player_aggregates(self, aggregates):
+        raise NotImplementedError
+
+    def rebuild_player_aggregates(self):
+        raise NotImplementedError
+
+    def get_deals(self, hand_record=None):
+        raise NotImplementedError
+
+    def partition_result_tables(self):
+        raise NotImplementedError
+
+    def create_staging_tables(self):
+        raise NotImplementedError
+
+    def swap_staging_tables(self):
+        raise NotImplementedError
+
+
+class MariaDBBackend(StorageBackend):
+
+    insert_ignore = 'INSERT IGNORE INTO'
+    table_options = ' ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;'
+
+    def __init__(self, cred_data):
+        super().__init__(cred_data)
+        self.conn = None
+        self.cur = None
+        self.connect()
+        #the schema is checked by the first connection to a database in the process, not by every writer
+        schema_key = (self.cred_data['system'], self.cred_data.get('host'), self.cred_data['database'])
+        if schema_key not in checked_schemas:
+            self.migrate()
+            checked_schemas.add(schema_key)
+
+    def migrate(self):
+        '''Builds any missing table with its keys and indexes, then applies the SCHEMA_MIGRATIONS the database
+        hasn't had yet, recording each one in schema_version_data'''
+        existing = self.existing_tables()
+        for table in self.table_list + self.config_table_list:
+            if table not in existing:
                 print('Building non-existant table' + table)
                 self.build_table(table)
+        self.cur.execute('SELECT MAX(version) FROM schema_version_data')
+        version = self.cur.fetchone()[0] or 0
+        for number, description, method in SCHEMA_MIGRATIONS:
+            if number <= version:
+                continue
+            print(f"Migrating schema to version {number}, {description}")
+            getattr(self, method)()
+            self.cur.execute('INSERT INTO schema_version_data (version, description, applied_at) VALUES (?, ?, ?)',
+                             (number, description, datetime.now().replace(microsecond=0)))
+            self.conn.commit()
 
-    def upload_df_to_database(self, df, table_name, prim_key=None,date_check=False):
+    def primary_keys(self):
+        #{table: primary key columns} for every table in the connected database
+        self.cur.execute('''SELECT table_name, column_name FROM information_schema.key_column_usage
+            WHERE table_schema = DATABASE() AND constraint_name = 'PRIMARY' ORDER BY table_name, ordinal_position''')
+        keys = {}
+        for table_name, column_name in self.cur.fetchall():
+            keys[table_name] = keys.get(table_name, ()) + (column_name,)
+        return keys
+
+    def replace_primary_key(self, table_name, columns, has_key):
+        #IGNORE drops the rows that would duplicate the new key instead of failing
+        drop = 'DROP PRIMARY KEY, ' if has_key else ''
+        self.cur.execute(f'ALTER IGNORE TABLE {table_name} {drop}ADD PRIMARY KEY ({", ".join(columns)})')
+
+    def migrate_primary_keys(self):
+        #tables built by older versions of the scraper can have no key or the wrong one
+        keys = self.primary_keys()
+        for table in self.table_list + self.config_table_list:
+            if keys.get(table) != primary_key(table):
+                print(f"Fixing the primary key of {table}")
+                self.replace_primary_key(table, primary_key(table), table in keys)
+
+    def migrate_indexes(self):
+        for table in self.table_list:
+            self.build_indexes(table)
 
+    def connect(self):
+        if mariadb is None:
+            raise ImportError('the mariadb backend needs the mariadb connector, pip install mariadb')
+        try:
+            self.conn = mariadb.connect(
+                user=self.cred_data['user'],
+                password=self.cred_data['password'],
+                host=self.cred_data['host'],
+                port=self.cred_data['port'],
+                database=self.cred_data['database']
+        )
+            print("link to database was created")
+            self.conn.autocommit = False
+            self.cur = self.conn.cursor()
+        except mariadb.Error as e:
+            print(f"Error connecting to MariaDB")
+
+    def upsert_sql(self, table_name, columns, prim_key, date_check):
         #this is a little ugly but don't want to update the player table unless it is new information
-        sql_columns = ', '.join(df.columns)
-        placeholders = ', '.join('?' for column in df.columns)
-       
+        sql_columns = ', '.join(columns)
+        placeholders = ', '.join('?' for column in columns)
         if date_check:
         # Add condition to only update rows where last updated is older
-            update_statements = ', '.join(f'{column} = CASE WHEN VALUES(last_updated) > last_updated THEN VALUES({column}) ELSE {column} END' for column in df.columns if column != prim_key)
+            update_statements = ', '.join(f'{column} = CASE WHEN VALUES(last_updated) > last_updated THEN VALUES({column}) ELSE {column} END' for column in columns if column != prim_key)
         else:
-            update_statements = ', '.join(f'{column} = VALUES({column})' for column in df.columns if column != prim_key)  # Exclude primary key column from updates
-
-
-        # Iterate over DataFrame rows
-        for idx, row in df.iterrows():
-            
-            if prim_key:
-                sql = f"""
-                INSERT INTO player_data ({sql_columns})
-                VALUES ({placeholders})
-                ON DUPLICATE KEY UPDATE {update_statements}
-                """
-            else:
-                sql = f"""
-                INSERT INTO {table_name} ({sql_columns})
-                VALUES ({placeholders})
-                """
-            try:
-                self.cur.execute(sql, tuple(row))
-            except mariadb.Error as e:
-                #trying to account for the duplicate records
-                print(e)
-
+            update_statements = ', '.join(f'{column} = VALUES({column})' for column in columns if column != prim_key)  # Exclude primary key column from updates
+        return f"""
+            INSERT INTO {self.table(table_name)} ({sql_columns})
+            VALUES ({placeholders})
+            ON DUPLICATE KEY UPDATE {update_statements}
+            """
+
+    def insert_sql(self, table_name, columns):
+        #duplicates are skipped rather than failing the whole batch
+        return f"""
+            {self.insert_ignore} {self.table(table_name)} ({', '.join(columns)})
+            VALUES ({', '.join('?' for column in columns)})
+            """
+
+    def upload_rows(self, table_name, columns, rows, prim_key=None,date_check=False, chunk_size=None, commit=True):
+        if prim_key:
+            sql = self.upsert_sql(table_name, columns, prim_key, date_check)
+        else:
+            sql = self.insert_sql(table_name, columns)
+
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        upload_start = time.perf_counter()
+        written = 0
+        for start in range(0, len(rows), chunk_size):
+            self.cur.executemany(sql, rows[start:start + chunk_size])
+            written += self.cur.rowcount
+        #an upsert counts updated rows twice so duplicates are only known for INSERT IGNORE
+        duplicates = len(rows) - written if not prim_key and 0 <= written <= len(rows) else None
+        self.record_upload(table_name, len(rows), time.perf_counter() - upload_start, duplicates)
+
+        if commit:
             self.conn.commit()
-    
+        return written
+
     def purge_db_contents(self):
         for table in self.table_list:
             sql = f'DELETE FROM {table};'
@@ -104,48 +902,258 @@ class DatabasePipeline():
         
         self.conn.commit()
 
+    def existing_tables(self):
+        #every table in the connected database from one query
+        self.cur.execute('SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE()')
+        return {result[0] for result in self.cur.fetchall()}
+
     def table_exists(self,table_name):
+        return table_name in self.existing_tables()
 
-        self.cur.execute(f'''
-            SELECT COUNT(*)
-            FROM information_schema.tables
-            WHERE table_name = '{table_name}'
-        ''')
-        if self.cur.fetchone()[0] == 1:
-            return True
 
-        return False
+    def get_game_list(self, club_nums=None):
+        #game_id is the primary key so there is no need to group, only the clubs being crawled are loaded
+        sql = f'SELECT `game_id` FROM `{self.table("game_data")}`'
+        params = ()
+        if club_nums:
+            sql += ' WHERE `club_num` IN (' + ', '.join('?' for club in club_nums) + ')'
+            params = tuple(club_nums)
+        self.cur.execute(sql, params)
+        game_id = {int(result[0]) for result in self.cur.fetchall()}
+
+        return game_id
+
+    def get_content_hashes(self, since):
+        #game_id -> content hash of the stored games played since the given date
+        self.cur.execute(f'SELECT h.`game_id`, h.`content_hash` FROM `{self.table("game_hash_data")}` h JOIN `{self.table("game_data")}` g ON g.`game_id` = h.`game_id` WHERE g.`start_date` >= ?', (since,))
+        return {int(result[0]): result[1] for result in self.cur.fetchall()}
+
+    def stored_rows(self, table_name, columns, section_ids):
+        #rows of a result table that belong to the given sections
+        placeholders = ', '.join('?' for section_id in section_ids)
+        if table_name == 'strat_result_summary_data':
+            where = f'pair_id_num IN (SELECT pair_id_num FROM {self.table("pair_results_data")} WHERE section_id IN ({placeholders}))'
+        else:
+            where = f'section_id IN ({placeholders})'
+        self.cur.execute(f'SELECT {", ".join(columns)} FROM {self.table(table_name)} WHERE {where}', tuple(section_ids))
+        return self.cur.fetchall()
+
+    def update_game(self, tables, watermark=None):
+        '''Writes a corrected game. The result tables in DIFF_KEYS are compared row by row with what is stored and only
+        rows that changed, appeared or disappeared are deleted and inserted, the rest of the game goes through the
+        usual INSERT IGNORE/upsert so new hands or players are added. All in one transaction like upload_game'''
+        section_ids = list(dict.fromkeys(tables['section_data'].data['section_id']))
+        table_name = None
+        player_rows = []
+        try:
+            #stored rows are read before anything is written, strat rows are found through pair_results_data
+            stored = {table_name: self.stored_rows(table_name, tables[table_name].columns, section_ids) if section_ids else [] for table_name in DIFF_KEYS}
+            for table_name, buffer in tables.items():
+                if table_name in DIFF_KEYS or len(buffer) == 0:
+                    continue
+                rows = buffer.rows()
+                if table_name == 'player_data':
+                    rows = player_rows = self.player_cache.changed(buffer.columns, rows)
+                    if not rows:
+                        continue
+                self.upload_rows(table_name, buffer.columns, rows, commit=False, **UPLOAD_OPTIONS.get(table_name, {}))
+            for table_name, key_columns in DIFF_KEYS.items():
+                columns = tables[table_name].columns
+                key_idx = [columns.index(column) for column in key_columns]
+                rows = tables[table_name].rows()
+                old_rows = {tuple(row[idx] for idx in key_idx): row for row in comparable_rows(table_name, columns, stored[table_name])}
+                new_rows = {}
+                #the parsed rows are what gets written, the comparable ones are only for finding the changes
+                parsed_rows = {}
+                for row, parsed_row in zip(comparable_rows(table_name, columns, rows), rows):
+                    key = tuple(row[idx] for idx in key_idx)
+                    new_rows[key] = row
+                    parsed_rows[key] = parsed_row
+                changed = [key for key, row in new_rows.items() if old_rows.get(key) != row]
+                removed = [key for key in old_rows if key not in new_rows]
+                if changed or removed:
+                    where = ' AND '.join(f'{column} = ?' for column in key_columns)
+                    self.cur.executemany(f'DELETE FROM {self.table(table_name)} WHERE {where}', changed + removed)
+                    if changed:
+                        self.upload_rows(table_name, columns, [parsed_rows[key] for key in changed], commit=False)
+                    if table_name == 'pair_results_data':
+                        #the whole game comes out of the player aggregates and goes back in, partners stay matched up
+                        game = tables['game_data'].data
+                        self.add_player_aggregates(player_aggregates(game['club_num'][0], game['start_date'][0],
+                                                                     added=list(new_rows.values()), removed=list(old_rows.values())))
+                    self.metrics[f'acbl/corrected_rows/{table_name}'] = self.metrics.get(f'acbl/corrected_rows/{table_name}', 0) + len(changed) + len(removed)
+            if watermark:
+                table_name = 'club_watermark_data'
+                self.update_watermark(*watermark, commit=False)
+            self.commit()
+        except Exception as e:
+            print(f"Rolling back corrected game, {table_name} failed: {e}")
+            self.record_error(e)
+            self.rollback()
+            return False
+        if player_rows:
+            self.player_cache.remember(TABLE_COLUMNS['player_data'], player_rows)
+        print(f"Updated corrected game {tables['game_data'].data['game_id'][0]}")
+        return True
+
+    def get_watermarks(self):
+        #club_num -> (last_game_id, last_game_date) of the newest game stored from each club listing
+        self.cur.execute(f'SELECT `club_num`, `last_game_id`, `last_game_date` FROM `{self.table("club_watermark_data")}`')
+        return {int(result[0]): (int(result[1]), result[2]) for result in self.cur.fetchall()}
+
+    def watermark_sql(self):
+        return f'''
+        INSERT INTO {self.table('club_watermark_data')} (club_num, last_game_id, last_game_date)
+        VALUES (?, ?, ?)
+        ON DUPLICATE KEY UPDATE last_game_id = CASE WHEN VALUES(last_game_date) >= last_game_date THEN VALUES(last_game_id) ELSE last_game_id END,
+        last_game_date = GREATEST(last_game_date, VALUES(last_game_date))
+        '''
+
+    def update_watermark(self, club_num, game_id, game_date, commit=True):
+        #only ever moves forward, an older game written late leaves the watermark alone
+        self.cur.execute(self.watermark_sql(), (club_num, game_id, game_date))
+        if commit:
+            self.conn.commit()
+
+    def register_clubs(self, clubs):
+        #clubs is a list of (club_num, url), clubs already in the registry are left as they are
+        self.cur.executemany(f'{self.insert_ignore} club_registry_data (club_num, url, active, idle_polls) VALUES (?, ?, 1, 0)', clubs)
+        self.conn.commit()
+
+    def get_club_registry(self):
+        #active clubs as (club_num, url, next_poll, idle_polls)
+        self.cur.execute('SELECT `club_num`, `url`, `next_poll`, `idle_polls` FROM `club_registry_data` WHERE `active` = 1')
+        return [(int(result[0]), result[1], result[2], int(result[3])) for result in self.cur.fetchall()]
+
+    def record_poll(self, club_num, polled, next_poll, idle_polls):
+        self.cur.execute('UPDATE club_registry_data SET last_polled = ?, next_poll = ?, idle_polls = ? WHERE club_num = ?', (polled, next_poll, idle_polls, club_num))
+        self.conn.commit()
+
+    def claim_sql(self):
+        #a key is taken over when it isn't done and its lease ran out, or renewed when the owner already holds it
+        return '''
+        INSERT INTO work_claim_data (claim_key, owner, lease_until, done)
+        VALUES (?, ?, ?, 0)
+        ON DUPLICATE KEY UPDATE owner = CASE WHEN done = 0 AND (lease_until < ? OR owner = VALUES(owner)) THEN VALUES(owner) ELSE owner END,
+        lease_until = CASE WHEN done = 0 AND (lease_until < ? OR owner = VALUES(owner)) THEN VALUES(lease_until) ELSE lease_until END
+        '''
+
+    def claim_work(self, keys, owner, lease_until, now):
+        '''Leases keys like game:<id> or club:<num> to owner until lease_until, returns the set of keys it got.
+        The insert locks each row so two instances claiming the same key can't both read themselves back as the owner'''
+        if not keys:
+            return set()
+        self.cur.executemany(self.claim_sql(), [(key, owner, lease_until, now, now) for key in keys])
+        self.cur.execute('SELECT claim_key FROM work_claim_data WHERE owner = ? AND done = 0 AND claim_key IN (' + ', '.join('?' for key in keys) + ')', (owner, *keys))
+        claimed = {result[0] for result in self.cur.fetchall()}
+        self.conn.commit()
+        return claimed
 
+    def finish_work(self, keys, owner):
+        #done keys are never claimed again
+        self.cur.executemany('UPDATE work_claim_data SET done = 1 WHERE claim_key = ? AND owner = ?', [(key, owner) for key in keys])
+        self.conn.commit()
+
+    def release_work(self, keys, owner):
+        #gives a key back straight away instead of waiting for the lease to run out
+        self.cur.executemany('UPDATE work_claim_data SET lease_until = ? WHERE claim_key = ? AND owner = ? AND done = 0', [(datetime(2000, 1, 1), key, owner) for key in keys])
+        self.conn.commit()
 
-    def get_game_list(self):
-        sql = f'SELECT `game_id` FROM `game_data` GROUP BY `game_id`'
-        self.cur.execute(sql)
+    def get_game_dates(self, since):
+        #club_num -> sorted list of distinct game dates since the given date
+        self.cur.execute(f'SELECT DISTINCT `club_num`, `start_date` FROM `{self.table("game_data")}` WHERE `start_date` >= ? ORDER BY `club_num`, `start_date`', (since,))
+        game_dates = {}
+        for club_num, start_date in self.cur.fetchall():
+            game_dates.setdefault(int(club_num), []).append(start_date)
+        return game_dates
+
+    def accumulate_sql(self, table_name):
+        #adds the sums to an existing row and keeps the latest and earliest dates
+        spec = PLAYER_AGGREGATES[table_name]
+        columns = spec['keys'] + spec['sums'] + spec['latest'] + spec['earliest']
+        updates = [f'{column} = {column} + VALUES({column})' for column in spec['sums']]
+        updates += [f'{column} = GREATEST(COALESCE({column}, VALUES({column})), VALUES({column}))' for column in spec['latest']]
+        updates += [f'{column} = LEAST(COALESCE({column}, VALUES({column})), VALUES({column}))' for column in spec['earliest']]
+        return f'''
+        INSERT INTO {self.table(table_name)} ({', '.join(columns)})
+        VALUES ({', '.join('?' for column in columns)})
+        ON DUPLICATE KEY UPDATE {', '.join(updates)}
+        '''
+
+    def add_player_aggregates(self, aggregates):
+        #part of the game's transaction, the caller commits
+        for table_name, rows in aggregates.items():
+            if rows:
+                self.cur.executemany(self.accumulate_sql(table_name), rows)
+
+    def month_sql(self, column):
+        return f"DATE_FORMAT({column}, '%Y-%m-01')"
+
+    def rebuild_player_aggregates(self):
+        '''Recomputes the player aggregate tables from everything in pair_results_data, for a backfill or if they
+        are ever in doubt. Gives the same numbers the ingest keeps up incrementally'''
+        results = f'''{self.table('pair_results_data')} p
+            JOIN {self.table('section_data')} s ON s.section_id = p.section_id
+            JOIN {self.table('game_data')} g ON g.game_id = s.game_id'''
+        sums = 'COUNT(*), SUM(COALESCE(p.percentage, 0)), SUM(COALESCE(p.mp_earned, 0))'
+        for table_name in PLAYER_AGGREGATES:
+            self.cur.execute(f'DELETE FROM {self.table(table_name)}')
+        self.cur.execute(f'''INSERT INTO {self.table('player_month_data')} (acbl_num, month, sessions, percentage_sum, mp_earned)
+            SELECT p.acbl_num, {self.month_sql('g.start_date')}, {sums} FROM {results}
+            WHERE COALESCE(p.acbl_num, 0) <> 0 GROUP BY p.acbl_num, {self.month_sql('g.start_date')}''')
+        self.cur.execute(f'''INSERT INTO {self.table('player_partner_data')} (acbl_num, partner_num, sessions, percentage_sum, mp_earned, last_played)
+            SELECT p.acbl_num, q.acbl_num, {sums}, MAX(g.start_date) FROM {results}
+            JOIN {self.table('pair_results_data')} q ON q.pair_id_num = p.pair_id_num AND q.acbl_num <> p.acbl_num
+            WHERE COALESCE(p.acbl_num, 0) <> 0 AND COALESCE(q.acbl_num, 0) <> 0 GROUP BY p.acbl_num, q.acbl_num''')
+        self.cur.execute(f'''INSERT INTO {self.table('player_club_data')} (acbl_num, club_num, sessions, percentage_sum, mp_earned, first_played, last_played)
+            SELECT p.acbl_num, g.club_num, {sums}, MIN(g.start_date), MAX(g.start_date) FROM {results}
+            WHERE COALESCE(p.acbl_num, 0) <> 0 GROUP BY p.acbl_num, g.club_num''')
+        self.conn.commit()
+        print("Player aggregates rebuilt")
+
+    def get_deals(self, hand_record=None):
+        '''Loads compact deals as (hand_ids, deals) where deals is an (n_boards, 52) int8 array of seat indexes'''
+        sql = 'SELECT `hand_id`, `deal` FROM `hand_deal_data`'
+        params = ()
+        if hand_record:
+            sql += ' WHERE `hand_record` = ?'
+            params = (hand_record,)
+        sql += ' ORDER BY `hand_id`'
+        self.cur.execute(sql, params)
         results = self.cur.fetchall()
-        game_id = [int(result[0]) for result in results]
+        hand_ids = np.array([result[0] for result in results], dtype=np.int64)
+        return hand_ids, parse_deal_strings([result[1] for result in results])
 
-        return game_id
+    def create_staging_tables(self):
+        #fresh empty copies of every table, anything left from an earlier failed rebuild is dropped
+        for table in self.table_list:
+            self.cur.execute(f'DROP TABLE IF EXISTS {table}{self.staging_suffix}')
+            self.build_table(table, suffix=self.staging_suffix)
+
+    def rename_tables(self, renames):
+        #renames is a list of (old name, new name), all done in one atomic statement
+        self.cur.execute('RENAME TABLE ' + ', '.join(f'{old} TO {new}' for old, new in renames))
+
+    def swap_staging_tables(self):
+        '''Swaps the loaded staging tables in with one atomic RENAME TABLE so readers never see empty tables,
+        then drops the old tables'''
+        for table in self.table_list:
+            self.cur.execute(f'DROP TABLE IF EXISTS {table}_old')
+        renames = []
+        for table in self.table_list:
+            renames += [(table, f'{table}_old'), (f'{table}{self.staging_suffix}', table)]
+        self.rename_tables(renames)
+        for table in self.table_list:
+            self.cur.execute(f'DROP TABLE IF EXISTS {table}_old')
+        self.conn.commit()
+        print("Staging tables swapped in")
+
+    def table_definition(self, table_name):
+        return TABLE_DEFINITIONS[table_name]
 
-    def build_table(self,table_name):
-        sql = f'CREATE TABLE IF NOT EXISTS {table_name}'
-
-        if table_name == 'club_data':
-            sql += ' (`club_num` int(7) NOT NULL,`club_name` varchar(45) NOT NULL,`unit_num` smallint(6) NOT NULL,`district_num` smallint(6) NOT NULL,`manager_num` int(10) DEFAULT NULL,`alias` varchar(10) DEFAULT NULL, PRIMARY KEY (`emp_no`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;'
-        elif table_name == 'game_data':
-            sql += ' (`game_id` int(7) NOT NULL,`game_name` varchar(90) DEFAULT NULL,`game_rating` tinyint(4) NOT NULL,`club_num` int(7) NOT NULL,`game_type` varchar(30) NOT NULL,`scoring_method` varchar(15) NOT NULL,`start_date` date NOT NULL,`end_date` date DEFAULT NULL,`session_cnt` tinyint(4) NOT NULL,`section_cnt` tinyint(4) NOT NULL, PRIMARY KEY (`game_id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;'
-        elif table_name == 'hand_possibility_data':
-            sql += ' (`hand_id` int(11) NOT NULL,`hand_record` varchar(10) NOT NULL,`board` tinyint(4) NOT NULL,`board_id_num` int(15) DEFAULT NULL,`dealer` varchar(1) NOT NULL,`vulnerability` varchar(10) NOT NULL,`double_dummy_ew` varchar(40) NOT NULL,`double_dummy_ns` varchar(45) NOT NULL,`par` varchar(40) NOT NULL,PRIMARY KEY (`id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;'
-        elif table_name == 'hand_records_data':
-            sql += ' (`hand_id` int(11) NOT NULL,`hand_record` varchar(10) NOT NULL,`board` tinyint(4) NOT NULL,`board_id_num` int(15) DEFAULT NULL,`direction` varchar(1) NOT NULL,`spades` varchar(13) NOT NULL,`hearts` varchar(13) NOT NULL,`diamonds` varchar(13) NOT NULL,`clubs` varchar(13) NOT NULL,PRIMARY KEY (`id`,`direction`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;'
-        elif table_name == 'hand_results_data':
-            sql += ' (`result_id` int(15) NOT NULL,`session_id` int(7) NOT NULL,`hand_record` varchar(9) NOT NULL,`section_id` int(7) NOT NULL,`board_id` int(15) NOT NULL,`board_num` tinyint(4) NOT NULL,`round_num` tinyint(4) NOT NULL,`table_num` tinyint(4) NOT NULL,`ns_pair` varchar(5) NOT NULL,`ew_pair` varchar(5) NOT NULL,`ns_score` int(6) NOT NULL,`ew_score` int(6) NOT NULL,`contract` varchar(10) DEFAULT NULL,`declarer` varchar(1) DEFAULT NULL,`ew_match_points` decimal(6,2) NOT NULL,`ns_match_points` decimal(6,2) NOT NULL,`opening_lead` varchar(4) DEFAULT NULL,`result` tinyint(4) DEFAULT NULL,`tricks_taken` tinyint(4) DEFAULT NULL,PRIMARY KEY (`result_id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;'
-        elif table_name == 'pair_results_data':
-            sql += ' (pair_id_num int(15) NOT NULL,session_id int(7) NOT NULL,section_id int(7) NOT NULL,acbl_num int(10) NOT NULL,pair varchar(6) NOT NULL,score decimal(6,2) NOT NULL,percentage decimal(6,2) NOT NULL,mp_earned decimal(5,2) DEFAULT NULL,direction varchar(2) DEFAULT NULL,PRIMARY KEY (pair_id_num,acbl_num)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;'
-        elif table_name == 'player_data':
-            sql += ' (`acbl_num` int(10) NOT NULL,`name` varchar(25) DEFAULT NULL,`city` varchar(20) DEFAULT NULL,`state` varchar(20) DEFAULT NULL,`master_points` float DEFAULT NULL,`bbo_username` varchar(20) DEFAULT NULL,`lifemaster` tinyint(1) NOT NULL,`last_updated` date NOT NULL,PRIMARY KEY (`acbl_num`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;'
-        elif table_name == 'section_data':
-            sql += '(`section_id` int(7) NOT NULL,`section_name` varchar(10) DEFAULT NULL,`game_id` int(7) NOT NULL,`session_id` int(7) NOT NULL,`hand_record` varchar(10) DEFAULT NULL,`boards_per` tinyint(4) DEFAULT NULL,`round_count` tinyint(4) DEFAULT NULL,`pair_count` smallint(6) DEFAULT NULL, PRIMARY KEY (`section_id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;'
-        elif table_name == 'strat_result_summary_data':
-            sql += ' (`strat_id` int(15) NOT NULL,`pair_id_num` int(15) NOT NULL,`strat_num` smallint(6) NOT NULL,`rank` tinyint(4) DEFAULT NULL,`strat_type` varchar(10) DEFAULT NULL,PRIMARY KEY (`strat_id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;'
+    def build_table(self,table_name, suffix=''):
+        if table_name in TABLE_DEFINITIONS:
+            sql = f'CREATE TABLE IF NOT EXISTS {table_name}{suffix} {self.table_definition(table_name)}{self.table_options}'
         else:
             print('Table has no definitiion')
             sql = None
@@ -153,18 +1161,691 @@ class DatabasePipeline():
         try:
             if sql:
                 self.cur.execute(sql)
+                self.build_indexes(table_name, suffix=suffix)
             else:
                 print('SQL is NoneType')
         except Exception as e:
             print(e)
 
+    def index_name(self, table_name, suffix, columns):
+        #mariadb index names only have to be unique within the table so they survive the staging rename as they are
+        return 'idx_' + '_'.join(columns)
+
+    def build_indexes(self, table_name, suffix=''):
+        for columns in TABLE_INDEXES.get(table_name, ()):
+            self.cur.execute(f'CREATE INDEX IF NOT EXISTS {self.index_name(table_name, suffix, columns)} ON {table_name}{suffix} ({", ".join(columns)})')
+
+    def partition_bounds(self, table_name):
+        '''(year, first key of the year) for every year with results in the table, from the games they belong to'''
+        column = PARTITIONED_TABLES[table_name]
+        if table_name == 'strat_result_summary_data':
+            sections = 'JOIN pair_results_data p ON p.pair_id_num = r.pair_id_num JOIN section_data s ON s.section_id = p.section_id'
+        else:
+            sections = 'JOIN section_data s ON s.section_id = r.section_id'
+        self.cur.execute(f'''SELECT YEAR(g.start_date), MIN(r.{column}) FROM {table_name} r {sections}
+            JOIN game_data g ON g.game_id = s.game_id GROUP BY YEAR(g.start_date) ORDER BY 1''')
+        return self.cur.fetchall()
+
+    def partition_result_tables(self):
+        '''Range partitions the result tables into one partition per year of games, the last year is open ended.
+        Old years can then be dropped or archived a partition at a time. Rerun it after new years of games come in,
+        and after a --rebuild since the staging tables are built unpartitioned. Rewrites the tables so it takes a while'''
+        for table_name, column in PARTITIONED_TABLES.items():
+            partitions = []
+            bound = None
+            for year, first_key in self.partition_bounds(table_name):
+                #a year whose first key isn't past the last bound (games posted late) stays in the earlier partition
+                if bound is not None and first_key > bound:
+                    partitions.append(f'PARTITION p{previous_year} VALUES LESS THAN ({first_key})')
+                    bound = first_key
+                elif bound is None:
+                    bound = first_key
+                previous_year = year
+            if bound is None:
+                print(f"No results in {table_name} to partition")
+                continue
+            partitions.append(f'PARTITION p{previous_year} VALUES LESS THAN MAXVALUE')
+            print(f"Partitioning {table_name} into {len(partitions)} partitions")
+            self.cur.execute(f'ALTER TABLE {table_name} PARTITION BY RANGE ({column}) ({", ".join(partitions)})')
+
+
+class SQLiteBackend(MariaDBBackend):
+    '''The same tables in a local sqlite file, "database" in db.json is the file path.
+    Handy for a single machine or a test run, sqlite allows one writer at a time so keep DB_WRITERS at 1 or 2'''
+
+    insert_ignore = 'INSERT OR IGNORE INTO'
+    table_options = ';'
+
+    def connect(self):
+        import sqlite3
+        #dates and datetimes go in as iso strings and come back as python objects by declared column type
+        sqlite3.register_adapter(date, lambda value: value.isoformat())
+        sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+        sqlite3.register_converter('date', lambda value: datetime.strptime(value.decode()[:10], '%Y-%m-%d').date())
+        sqlite3.register_converter('datetime', lambda value: datetime.fromisoformat(value.decode()))
+        #check_same_thread is off because a backend is built on one thread and used on its writer thread
+        self.conn = sqlite3.connect(self.cred_data['database'], timeout=60, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self.cur = self.conn.cursor()
+
+    def upsert_sql(self, table_name, columns, prim_key, date_check):
+        sql_columns = ', '.join(columns)
+        placeholders = ', '.join('?' for column in columns)
+        if date_check:
+            update_statements = ', '.join(f'{column} = CASE WHEN excluded.last_updated > last_updated THEN excluded.{column} ELSE {column} END' for column in columns if column != prim_key)
+        else:
+            update_statements = ', '.join(f'{column} = excluded.{column}' for column in columns if column != prim_key)
+        return f"""
+            INSERT INTO {self.table(table_name)} ({sql_columns})
+            VALUES ({placeholders})
+            ON CONFLICT({prim_key}) DO UPDATE SET {update_statements}
+            """
+
+    def watermark_sql(self):
+        return f'''
+        INSERT INTO {self.table('club_watermark_data')} (club_num, last_game_id, last_game_date)
+        VALUES (?, ?, ?)
+        ON CONFLICT(club_num) DO UPDATE SET last_game_id = CASE WHEN excluded.last_game_date >= last_game_date THEN excluded.last_game_id ELSE last_game_id END,
+        last_game_date = MAX(last_game_date, excluded.last_game_date)
+        '''
+
+    def insert_sql(self, table_name, columns):
+        #INSERT OR IGNORE would also drop rows with a NULL in a NOT NULL column, only key conflicts are skipped here
+        return f"""
+            INSERT INTO {self.table(table_name)} ({', '.join(columns)})
+            VALUES ({', '.join('?' for column in columns)})
+            ON CONFLICT DO NOTHING
+            """
+
+    def table_definition(self, table_name):
+        #mariadb's INSERT IGNORE stores 0 or '' for a missing value in a NOT NULL column (an empty ew_score for one),
+        #sqlite has no such coercion so the columns are left nullable and the value stays NULL
+        return TABLE_DEFINITIONS[table_name].replace(' NOT NULL', '')
+
+    def claim_sql(self):
+        return '''
+        INSERT INTO work_claim_data (claim_key, owner, lease_until, done)
+        VALUES (?, ?, ?, 0)
+        ON CONFLICT(claim_key) DO UPDATE SET owner = CASE WHEN done = 0 AND (lease_until < ? OR owner = excluded.owner) THEN excluded.owner ELSE owner END,
+        lease_until = CASE WHEN done = 0 AND (lease_until < ? OR owner = excluded.owner) THEN excluded.lease_until ELSE lease_until END
+        '''
+
+    def accumulate_sql(self, table_name):
+        spec = PLAYER_AGGREGATES[table_name]
+        columns = spec['keys'] + spec['sums'] + spec['latest'] + spec['earliest']
+        updates = [f'{column} = {column} + excluded.{column}' for column in spec['sums']]
+        updates += [f'{column} = MAX(COALESCE({column}, excluded.{column}), excluded.{column})' for column in spec['latest']]
+        updates += [f'{column} = MIN(COALESCE({column}, excluded.{column}), excluded.{column})' for column in spec['earliest']]
+        return f'''
+        INSERT INTO {self.table(table_name)} ({', '.join(columns)})
+        VALUES ({', '.join('?' for column in columns)})
+        ON CONFLICT({', '.join(spec['keys'])}) DO UPDATE SET {', '.join(updates)}
+        '''
+
+    def month_sql(self, column):
+        return f"strftime('%Y-%m-01', {column})"
+
+    def existing_tables(self):
+        self.cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        return {result[0] for result in self.cur.fetchall()}
+
+    def primary_keys(self):
+        keys = {}
+        for table_name in self.existing_tables():
+            self.cur.execute(f'PRAGMA table_info({table_name})')
+            columns = sorted((result[5], result[1]) for result in self.cur.fetchall() if result[5])
+            if columns:
+                keys[table_name] = tuple(column for position, column in columns)
+        return keys
+
+    def replace_primary_key(self, table_name, columns, has_key):
+        #sqlite can't alter a key, the table is copied into a new one built from TABLE_DEFINITIONS
+        self.cur.execute(f'PRAGMA table_info({table_name})')
+        existing = {result[1] for result in self.cur.fetchall()}
+        copied = ', '.join(column for column in TABLE_COLUMNS.get(table_name, ()) if column in existing) or '*'
+        self.cur.execute(f'DROP TABLE IF EXISTS {table_name}_migrate')
+        self.build_table(table_name, suffix='_migrate')
+        self.cur.execute(f'INSERT OR IGNORE INTO {table_name}_migrate ({copied}) SELECT {copied} FROM {table_name}')
+        self.cur.execute(f'DROP TABLE {table_name}')
+        self.cur.execute(f'ALTER TABLE {table_name}_migrate RENAME TO {table_name}')
+        for columns in TABLE_INDEXES.get(table_name, ()):
+            self.cur.execute(f'DROP INDEX IF EXISTS {self.index_name(table_name, "_migrate", columns)}')
+        self.build_indexes(table_name)
+
+    def index_name(self, table_name, suffix, columns):
+        #sqlite index names are unique across the database
+        return f'idx_{table_name}{suffix}_' + '_'.join(columns)
+
+    def partition_result_tables(self):
+        print("sqlite has no table partitioning, the indexes cover the date filters")
+
+    def swap_staging_tables(self):
+        super().swap_staging_tables()
+        #the indexes kept their staging names through the rename, they are rebuilt under the live names
+        for table in self.table_list:
+            for columns in TABLE_INDEXES.get(table, ()):
+                self.cur.execute(f'DROP INDEX IF EXISTS {self.index_name(table, self.staging_suffix, columns)}')
+            self.build_indexes(table)
+        self.conn.commit()
+
+    def rename_tables(self, renames):
+        #sqlite has no multi table rename but ddl is transactional, so the renames commit together
+        self.conn.commit()
+        self.cur.execute('BEGIN')
+        for old, new in renames:
+            self.cur.execute(f'ALTER TABLE {old} RENAME TO {new}')
+
+
+class ParquetBackend(StorageBackend):
+    '''Writes every game as parquet files partitioned by club and month, <root>/<table>/club=<club_num>/month=<YYYY-MM>/<game_id>.parquet,
+    which pyarrow.dataset, pandas, duckdb or spark read as a hive partitioned dataset. "database" in db.json is the root folder.
+    Watermarks are kept in <root>/_state and the club registry in <root>/_config. A game is one set of files, once a run is
+    over compact() merges each partition's game files into one larger file and a game written again replaces its earlier
+    rows there. The player_data files are an append only history of player rows'''
+
+    #work_claim_data lives in a sql database, instances writing parquet can't share a crawl
+    supports_claims = False
+
+    def __init__(self, cred_data):
+        super().__init__(cred_data)
+        #only needed for this backend
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.root = self.cred_data['database']
+        os.makedirs(self.data_root(), exist_ok=True)
+
+    def data_root(self):
+        #staged data goes under <root>/_staging and replaces the table folders on the swap
+        if self.staging:
+            return os.path.join(self.root, self.staging_suffix)
+        return self.root
+
+    def arrow_table(self, table_name, columns, rows):
+        #column types follow the sql definitions so every file of a table has the same schema
+        sql_types = column_types(table_name)
+        arrays = []
+        for column, values in zip(columns, zip(*rows)):
+            sql_type = sql_types.get(column, 'varchar')
+            if sql_type in ('int', 'tinyint', 'smallint', 'bigint'):
+                arrays.append(self.pa.array([None if value is None else int(value) for value in values], self.pa.int64()))
+            elif sql_type in ('decimal', 'float', 'double'):
+                arrays.append(self.pa.array([None if value is None else float(value) for value in values], self.pa.float64()))
+            elif sql_type == 'date':
+                arrays.append(self.pa.array(values, self.pa.date32()))
+            elif sql_type == 'datetime':
+                arrays.append(self.pa.array(values, self.pa.timestamp('s')))
+            else:
+                arrays.append(self.pa.array([None if value is None else str(value) for value in values], self.pa.string()))
+        return self.pa.Table.from_arrays(arrays, names=list(columns))
+
+    def write_table(self, path, table, replace=True):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        sink = self.pa.BufferOutputStream()
+        self.pq.write_table(table, sink)
+        return atomic_write(path, sink.getvalue(), replace=replace)
+
+    def upload_rows(self, table_name, columns, rows, prim_key=None,date_check=False, chunk_size=None, commit=True):
+        #rows that don't belong to a game are written as one file outside the partitions
+        if len(rows) == 0:
+            return
+        path = os.path.join(self.data_root(), table_name, f'{datetime.now():%Y%m%d%H%M%S}-{os.getpid()}-{threading.get_ident()}.parquet')
+        self.write_table(path, self.arrow_table(table_name, columns, rows))
+
+    def upload_game(self, tables, watermark=None):
+        '''writes every table for a game into its club and month partition, the files are renamed into place together
+        at the end so a failed game leaves nothing behind'''
+        game = tables['game_data'].data
+        game_id = game['game_id'][0]
+        partition = os.path.join(f"club={game['club_num'][0]}", f"month={game['start_date'][0]:%Y-%m}")
+        table_name = None
+        player_rows = []
+        written = []
+        try:
+            for table_name, buffer in tables.items():
+                rows = buffer.rows()
+                if table_name == 'player_data':
+                    rows = player_rows = self.player_cache.changed(buffer.columns, rows)
+                if len(rows) == 0:
+                    continue
+                upload_start = time.perf_counter()
+                path = os.path.join(self.data_root(), table_name, partition, f'{game_id}.parquet')
+                written.append((self.write_table(path, self.arrow_table(table_name, buffer.columns, rows), replace=False), path))
+                self.record_upload(table_name, len(rows), time.perf_counter() - upload_start)
+            for tmp_path, path in written:
+                os.replace(tmp_path, path)
+            if watermark:
+                table_name = 'club_watermark_data'
+                self.update_watermark(*watermark)
+        except Exception as e:
+            print(f"Dropping game, {table_name} failed: {e}")
+            self.record_error(e)
+            for tmp_path, path in written:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            return False
+        if player_rows:
+            self.player_cache.remember(TABLE_COLUMNS['player_data'], player_rows)
+        return True
+
+    def close(self):
+        pass
+
+    def dataset(self, table_name):
+        import pyarrow.dataset
+        path = os.path.join(self.data_root(), table_name)
+        if not os.path.isdir(path):
+            return None
+        return pyarrow.dataset.dataset(path, format='parquet', partitioning='hive')
+
+    def state_path(self, name, config=False):
+        return os.path.join(self.root if config else self.data_root(), '_config' if config else '_state', name + '.json')
+
+    def load_state(self, name, config=False):
+        path = self.state_path(name, config)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as file:
+            return json.load(file)
+
+    def save_state(self, name, state, config=False):
+        path = self.state_path(name, config)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, json.dumps(state, default=str))
+
+    def purge_db_contents(self):
+        import shutil
+        for table in self.table_list:
+            shutil.rmtree(os.path.join(self.root, table), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.root, '_state'), ignore_errors=True)
+
+    def get_game_list(self, club_nums=None):
+        #only the game_id column is read, compacted files hold many games so the file names can't be used
+        import pyarrow.dataset
+        dataset = self.dataset('game_data')
+        if dataset is None:
+            return set()
+        condition = pyarrow.dataset.field('club_num').isin(list(club_nums)) if club_nums else None
+        return set(dataset.to_table(columns=['game_id'], filter=condition).column('game_id').to_pylist())
+
+    def get_content_hashes(self, since):
+        import pyarrow.dataset
+        hashes = self.dataset('game_hash_data')
+        games = self.dataset('game_data')
+        if hashes is None or games is None:
+            return {}
+        recent = set(games.to_table(columns=['game_id'], filter=pyarrow.dataset.field('start_date') >= since).column('game_id').to_pylist())
+        return {row['game_id']: row['content_hash'] for row in hashes.to_table(columns=['game_id', 'content_hash']).to_pylist() if row['game_id'] in recent}
+
+    def get_watermarks(self):
+        return {int(club_num): (int(game_id), datetime.fromisoformat(game_date)) for club_num, (game_id, game_date) in self.load_state('watermarks').items()}
+
+    def update_watermark(self, club_num, game_id, game_date, commit=True):
+        #only ever moves forward, the lock keeps writer threads from losing each other's updates
+        with parquet_state_lock:
+            watermarks = self.load_state('watermarks')
+            current = watermarks.get(str(club_num))
+            if current is None or game_date >= datetime.fromisoformat(current[1]):
+                watermarks[str(club_num)] = (game_id, game_date.isoformat(' '))
+                self.save_state('watermarks', watermarks)
+
+    def register_clubs(self, clubs):
+        with parquet_state_lock:
+            registry = self.load_state('club_registry', config=True)
+            for club_num, url in clubs:
+                registry.setdefault(str(club_num), {'url': url, 'active': 1, 'last_polled': None, 'next_poll': None, 'idle_polls': 0})
+            self.save_state('club_registry', registry, config=True)
+
+    def get_club_registry(self):
+        registry = self.load_state('club_registry', config=True)
+        return [(int(club_num), club['url'], datetime.fromisoformat(club['next_poll']) if club['next_poll'] else None, int(club['idle_polls']))
+                for club_num, club in registry.items() if club['active']]
+
+    def record_poll(self, club_num, polled, next_poll, idle_polls):
+        with parquet_state_lock:
+            registry = self.load_state('club_registry', config=True)
+            if str(club_num) in registry:
+                registry[str(club_num)].update({'last_polled': polled.isoformat(' '), 'next_poll': next_poll.isoformat(' '), 'idle_polls': idle_polls})
+                self.save_state('club_registry', registry, config=True)
+
+    def get_game_dates(self, since):
+        import pyarrow.dataset
+        dataset = self.dataset('game_data')
+        game_dates = {}
+        if dataset is None:
+            return game_dates
+        games = dataset.to_table(columns=['club_num', 'start_date'], filter=pyarrow.dataset.field('start_date') >= since).to_pylist()
+        for game in games:
+            game_dates.setdefault(int(game['club_num']), set()).add(game['start_date'])
+        return {club_num: sorted(dates) for club_num, dates in game_dates.items()}
+
+    def get_deals(self, hand_record=None):
+        '''Loads compact deals as (hand_ids, deals) where deals is an (n_boards, 52) int8 array of seat indexes'''
+        import pyarrow.dataset
+        dataset = self.dataset('hand_deal_data')
+        if dataset is None:
+            return np.array([], dtype=np.int64), parse_deal_strings([])
+        condition = pyarrow.dataset.field('hand_record') == hand_record if hand_record else None
+        deals = dataset.to_table(columns=['hand_id', 'deal'], filter=condition).to_pandas().drop_duplicates('hand_id').sort_values('hand_id')
+        return deals['hand_id'].to_numpy(dtype=np.int64), parse_deal_strings(deals['deal'].tolist())
+
+    def rebuild_player_aggregates(self):
+        print("The parquet backend keeps no player aggregates, group pair_results_data with the dataset readers instead")
+
+    def partition_result_tables(self):
+        print("Parquet files are already partitioned by club and month")
+
+    def compact(self):
+        '''Merges the files of every partition into one, a game a file adds up to tens of thousands of small files
+        over the years. Rows are read oldest file first and a rewritten game's rows replace the ones it had before
+        by primary key, player_data keeps every row as it is a history. Run when no writer is busy'''
+        merged = 0
+        for table_name in self.table_list:
+            table_root = os.path.join(self.data_root(), table_name)
+            for dirpath, dirnames, filenames in os.walk(table_root):
+                paths = sorted((os.path.join(dirpath, filename) for filename in filenames if filename.endswith('.parquet')), key=os.path.getmtime)
+                if len(paths) < 2:
+                    continue
+                table = self.pa.concat_tables([self.pq.read_table(path, partitioning=None) for path in paths])
+                if table_name != 'player_data':
+                    #the last row read for every key is kept
+                    table = table.append_column('_row', self.pa.array(range(table.num_rows), self.pa.int64()))
+                    keep = table.group_by(list(primary_key(table_name))).aggregate([('_row', 'max')]).column('_row_max')
+                    table = table.take(sorted(keep.to_pylist())).drop_columns(['_row'])
+                path = os.path.join(dirpath, f'part-{datetime.now():%Y%m%d%H%M%S}-{os.getpid()}.parquet')
+                self.write_table(path, table)
+                for old_path in paths:
+                    os.remove(old_path)
+                merged += len(paths)
+        print(f"Compacted {merged} parquet files")
+
+    def create_staging_tables(self):
+        import shutil
+        shutil.rmtree(os.path.join(self.root, self.staging_suffix), ignore_errors=True)
+        os.makedirs(self.data_root(), exist_ok=True)
+
+    def swap_staging_tables(self):
+        '''Moves each staged table folder in place of the live one, a reader sees either the old or the new folder'''
+        import shutil
+        staging_root = os.path.join(self.root, self.staging_suffix)
+        for name in self.table_list + ('_state',):
+            staged = os.path.join(staging_root, name)
+            live = os.path.join(self.root, name)
+            shutil.rmtree(live + '_old', ignore_errors=True)
+            if os.path.exists(live):
+                os.replace(live, live + '_old')
+            if os.path.exists(staged):
+                os.replace(staged, live)
+            shutil.rmtree(live + '_old', ignore_errors=True)
+        shutil.rmtree(staging_root, ignore_errors=True)
+        print("Staging tables swapped in")
+
+#watermarks and the registry are json files shared by every writer thread in the process
+parquet_state_lock = threading.Lock()
+#(system, host, database) already checked for missing tables by this process
+checked_schemas = set()
+
+STORAGE_BACKENDS = {
+    'mariadb': MariaDBBackend,
+    'sqlite': SQLiteBackend,
+    'parquet': ParquetBackend,
+}
+
+def open_database(file_path=os.path.join('settings', 'db.json')):
+    '''The storage backend named by system in db.json with its own connection'''
+    with open(file_path,'r') as file:
+        cred_data = json.load(file)
+    #allow flexibilty on the database type to be allowed to do this at work and test environment
+    if cred_data['system'] not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown database system {cred_data['system']}, expected one of {', '.join(STORAGE_BACKENDS)}")
+    return STORAGE_BACKENDS[cred_data['system']](cred_data)
+
+#the backend used by the spider and __main__, the writer threads and replay workers open their own
+shared_db = None
+
+def shared_database():
+    global shared_db
+    if shared_db is None:
+        shared_db = open_database()
+    return shared_db
+
+class GameItem(scrapy.Item):
+    #one finished game, tables is the dict of TableBuffer from normalize_game
+    game_id = scrapy.Field()
+    tables = scrapy.Field()
+    #raw var data json bytes, kept in the RawArchive
+    payload = scrapy.Field()
+    #club listing the game came from and its date there, used for the club watermark
+    club_num = scrapy.Field()
+    listing_date = scrapy.Field()
+    #a stored game fetched again whose content hash changed, written with update_game
+    recheck = scrapy.Field()
+    #work_claim_data key the game was claimed under, marked done once the game is written
+    claim_key = scrapy.Field()
+
+    def __repr__(self):
+        #scrapy logs every scraped item, the payload and tables of a big sectional would be most of a megabyte of log
+        fields = {key: value for key, value in self.items() if key not in ('payload', 'tables')}
+        payload = self.get('payload')
+        return f"GameItem({fields}, payload={len(payload) if payload else 0} bytes, tables={len(self.get('tables') or {})})"
+
+
+class GameWriterPipeline():
+    '''Scrapy item pipeline that writes games on background threads so the reactor keeps downloading.
+    Each writer thread owns its own database connection. At most DB_WRITE_QUEUE games are queued, past that
+    process_item waits for a writer to free a slot which lets scrapy apply its own backpressure'''
+
+    def __init__(self, writers=2, queue_size=8, stats=None, crawler=None):
+        self.writers = writers
+        self.queue_size = queue_size
+        self.stats = stats
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(writers=crawler.settings.getint('DB_WRITERS', 2), queue_size=crawler.settings.getint('DB_WRITE_QUEUE', 8), stats=crawler.stats,
+                   crawler=crawler)
+
+    def open_spider(self):
+        spider = self.spider = self.crawler.spider
+        self.archive = RawArchive(spider.mydb.archive_dir) if spider.mydb.archive_dir else None
+        self.queue = queue.Queue()
+        self.slots = defer.DeferredSemaphore(self.queue_size)
+        self.threads = []
+        for writer_num in range(self.writers):
+            thread = threading.Thread(target=self.drain_queue, args=(open_database(),), name=f'db-writer-{writer_num}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    async def process_item(self, item):
+        if not isinstance(item, GameItem):
+            return item
+        await maybe_deferred_to_future(self.slots.acquire())
+        self.queue.put(item)
+        return item
+
+    def drain_queue(self, db):
+        from twisted.internet import reactor
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            metrics = {}
+            try:
+                #archived first so a game that fails to write can still be replayed
+                if self.archive is not None and item.get('payload'):
+                    stage_start = time.perf_counter()
+                    self.archive.put(item['game_id'], item['payload'])
+                    metrics['acbl/stage_seconds/archive'] = time.perf_counter() - stage_start
+                #only moved up to where every older game of the listing is written, see ACBL_spider.safe_watermark
+                watermark = self.spider.safe_watermark(item.get('club_num'), item['game_id']) if item.get('club_num') else None
+                stage_start = time.perf_counter()
+                if item.get('recheck'):
+                    written = db.update_game(item['tables'], watermark=watermark)
+                else:
+                    written = db.upload_game(item['tables'], watermark=watermark)
+                metrics['acbl/stage_seconds/upload'] = time.perf_counter() - stage_start
+                if written:
+                    self.spider.already_pulled.add(item['game_id'])
+                self.spider.listed_game_done(item.get('club_num'), item['game_id'], written)
+                if item.get('claim_key') and self.spider.claim_work:
+                    #a written game is done for every instance, a failed one is handed back for another try
+                    if written:
+                        db.finish_work([item['claim_key']], self.spider.claim_owner)
+                    else:
+                        db.release_work([item['claim_key']], self.spider.claim_owner)
+                metrics.update(db.take_metrics())
+                if item.get('recheck'):
+                    metrics['acbl/games_corrected' if written else 'acbl/games_failed'] = 1
+                else:
+                    metrics['acbl/games_written' if written else 'acbl/games_failed'] = 1
+            except Exception as e:
+                #anything the backend doesn't catch (the archive, the claim updates) fails this game only,
+                #a dead writer would leave the rest of the queue unwritten and close_spider waiting on it for ever
+                self.spider.logger.error(f"Writing game {item.get('game_id')} failed: {e}")
+                self.spider.listed_game_done(item.get('club_num'), item.get('game_id'), False)
+                metrics['acbl/games_failed'] = 1
+            finally:
+                #stats are only touched on the reactor thread
+                reactor.callFromThread(self.record_metrics, metrics)
+                reactor.callFromThread(self.slots.release)
+        db.close()
+
+    def record_metrics(self, metrics):
+        if self.stats is not None:
+            for key, value in metrics.items():
+                self.stats.inc_value(key, value)
+
+    async def close_spider(self):
+        #everything already queued is written before the spider finishes
+        for thread in self.threads:
+            self.queue.put(None)
+        await maybe_deferred_to_future(threads.deferToThread(self.join_writers))
+
+    def join_writers(self):
+        for thread in self.threads:
+            thread.join()
+
+
+class ClubScheduler():
+    '''Decides which registered clubs get polled on this run.
+    A club's cadence is the median gap between its games in game_data. It is polled at half that gap, clamped to
+    min_hours and max_hours, and the interval doubles for every poll in a row that found nothing new.
+    Clubs with no history are polled every min_hours until they build one'''
+
+    history_days = 180
+    max_backoff = 4
+
+    def __init__(self, db, min_hours=12, max_hours=24 * 14):
+        self.db = db
+        self.min_hours = min_hours
+        self.max_hours = max_hours
+        self.cadence = {}
+        since = (datetime.now() - timedelta(days=self.history_days)).date()
+        for club_num, dates in db.get_game_dates(since).items():
+            if len(dates) > 1:
+                gaps = sorted((later - earlier).days for earlier, later in zip(dates, dates[1:]))
+                self.cadence[club_num] = gaps[len(gaps) // 2]
+
+    def poll_interval(self, club_num, idle_polls):
+        hours = self.min_hours
+        if club_num in self.cadence:
+            hours = max(self.min_hours, self.cadence[club_num] * 24 / 2)
+        hours *= 2 ** min(idle_polls, self.max_backoff)
+        return timedelta(hours=min(hours, self.max_hours))
+
+    def due_clubs(self, limit=None, now=None):
+        #the most overdue clubs first, never more than limit of them in one run
+        now = now or datetime.now()
+        due = [club for club in self.db.get_club_registry() if club[2] is None or club[2] <= now]
+        due.sort(key=lambda club: club[2] or datetime.min)
+        self.idle_polls = {club[0]: club[3] for club in due}
+        return [(club[0], club[1]) for club in due[:limit]]
+
+    def record_poll(self, club_num, found_new, now=None):
+        now = now or datetime.now()
+        idle_polls = 0 if found_new else self.idle_polls.get(club_num, 0) + 1
+        self.idle_polls[club_num] = idle_polls
+        self.db.record_poll(club_num, now, now + self.poll_interval(club_num, idle_polls), idle_polls)
+
+
+class MetricsExporter():
+    '''Scrapy extension that writes the crawl stats out when the spider closes, <METRICS_FILE>.prom in the prometheus
+    text format for the node exporter textfile collector and <METRICS_FILE>.json with the same numbers.
+    The acbl/<name>/<label> stats become acbl_<name>{<label name>="<label>"}, scrapy's own stats are prefixed scrapy_'''
+
+    label_names = {
+        'acbl/stage_seconds': 'stage',
+        'acbl/stage_count': 'stage',
+        'acbl/fetch_seconds': 'page',
+        'acbl/fetch_count': 'page',
+        'acbl/page_bytes': 'page',
+        'acbl/fetch_errors': 'error',
+        'acbl/games_skipped': 'reason',
+        'acbl/clubs_skipped': 'reason',
+        'acbl/upload_rows': 'table',
+        'acbl/upload_seconds': 'table',
+        'acbl/duplicate_rows': 'table',
+        'acbl/corrected_rows': 'table',
+        'acbl/db_errors': 'error',
+    }
+
+    def __init__(self, stats, path):
+        self.stats = stats
+        self.path = path
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        exporter = cls(crawler.stats, crawler.settings.get('METRICS_FILE', os.path.join('metrics', 'acbl_scraper')))
+        crawler.signals.connect(exporter.spider_closed, signal=signals.spider_closed)
+        return exporter
+
+    def metric(self, key):
+        #(metric name, labels) for a stats key
+        parts = key.split('/')
+        if parts[0] == 'acbl':
+            base = '/'.join(parts[:2])
+            if base in self.label_names and len(parts) > 2:
+                return 'acbl_' + parts[1], {self.label_names[base]: '/'.join(parts[2:])}
+            return re.sub(r'\W', '_', key), {}
+        return 'scrapy_' + re.sub(r'\W', '_', key), {}
+
+    def spider_closed(self, spider, reason):
+        values = {key: value for key, value in self.stats.get_stats().items() if isinstance(value, (int, float))}
+        values['acbl/last_run_timestamp_seconds'] = time.time()
+        metrics = {}
+        for key, value in sorted(values.items()):
+            name, labels = self.metric(key)
+            metrics.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, samples in metrics.items():
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in samples:
+                label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels.items())
+                lines.append(f'{name}{{{label_text}}} {float(value)}' if label_text else f'{name} {float(value)}')
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        #the textfile collector never reads half a file
+        atomic_write(self.path + '.prom', '\n'.join(lines) + '\n')
+        atomic_write(self.path + '.json', json.dumps(values, indent=1, sort_keys=True))
+        print(f"Metrics written to {self.path}.prom")
+
 
 class ACBL_spider(scrapy.Spider):
     name = 'acbl_club_spider'
     #go to the acbl live clubs site and find the clubs you want to follow and place their ID here
+    #these and any clubs listed in settings/clubs.json are added to the club registry, see ClubScheduler
     start_urls = ['https://my.acbl.org/club-results/261750','https://my.acbl.org/club-results/275149','https://my.acbl.org/club-results/276287','https://my.acbl.org/club-results/273540','https://my.acbl.org/club-results/264820'] 
-    mydb = DatabasePipeline()
-    already_pulled = mydb.get_game_list()
+    #clubs without a watermark follow this to older pages of results to backfill their history
+    next_page_xpath = '//a[@rel="next"]/@href'
+    club_url = 'https://my.acbl.org/club-results/{}'
+    clubs_file = os.path.join('settings', 'clubs.json')
+    #polling limits for the ClubScheduler, max_clubs_per_run is the listing budget for one run
+    min_poll_hours = 12
+    max_poll_hours = 24 * 14
+    max_clubs_per_run = 200
+    #how long a claimed club listing or game stays with this instance before another one may take it over
+    claim_minutes = 30
     headerlist = [
         {'User-Agent': 'Opera/9.80 (X11; Linux i686; Ubuntu/14.10) Presto/2.12.388 Version/12.16'},
         {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_2) AppleWebKit/601.3.9 (KHTML, like Gecko) Version/9.0.2 Safari/601.3.9'},
@@ -172,93 +1853,322 @@ class ACBL_spider(scrapy.Spider):
         ]
     max_data_age = 14
     current_date = datetime.now()
-
-    def __init__(self, date_limit=False, *args, **kwargs):
+    custom_settings = {
+        'ITEM_PIPELINES': {GameWriterPipeline: 300},
+        'EXTENSIONS': {MetricsExporter: 500},
+        #spread the requests out, with hundreds of clubs the site should see a steady trickle not a burst
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 4,
+        'DOWNLOAD_DELAY': 0.5,
+        'AUTOTHROTTLE_ENABLED': True,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 2.0,
+    }
+
+    def __init__(self, date_limit=False, poll_all=False, parse_workers=0, recheck_days=0, claim_work=False, *args, **kwargs):
         super(ACBL_spider, self).__init__(*args, **kwargs)
+        #set of game ids already stored for the registered clubs, games written during the run are added to it
+        self.already_pulled = set()
+        #newest stored game per club listing, reading a listing stops once it reaches a stored game
+        self.watermarks = {}
+        #club -> {game_id: [listing date, state]} for the games requested from its listing this run, the state is
+        #pending, written or failed. A club's watermark never passes a game that isn't written, the next run stops at
+        #the watermark so a failed game above it would never be fetched again
+        self.listed_games = {}
+        #clubs whose listing still has a page being fetched, older games may still turn up
+        self.open_listings = set()
+        self.listing_lock = threading.Lock()
+        #stored games played in the last recheck_days are fetched again and rewritten if their content hash changed
+        self.recheck_days = int(recheck_days)
+        self.recheck_after = None
+        self.content_hashes = {}
         self.date_limit = date_limit
+        self.poll_all = poll_all
+        #game the get_* DataFrame views were last built from
+        self.normalized_data = None
+        self.normalized_tables = None
+        #with several instances crawling at once, clubs and games are leased through work_claim_data so each is fetched once
+        self.claim_work = claim_work
+        self.claim_owner = f'{socket.gethostname()}:{os.getpid()}'
+        #json decoding and normalizing can be handed to worker processes so the reactor keeps downloading
+        self.parse_pool = None
+        if parse_workers:
+            #spawned rather than forked, the crawl already has writer threads running
+            self.parse_pool = ProcessPoolExecutor(max_workers=int(parse_workers), mp_context=multiprocessing.get_context('spawn'))
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.open_spider, signal=signals.spider_opened)
+        return spider
+
+    @property
+    def mydb(self):
+        #opened on first use so importing the module or building the spider never touches the database
+        return shared_database()
+
+    def open_spider(self, spider):
+        if self.claim_work and not self.mydb.supports_claims:
+            #the parquet backend has no work_claim_data, crawling unclaimed is still right for a single instance
+            self.logger.warning(f"claim_work needs a sql database, {self.mydb.cred_data['system']} can't share a crawl, crawling without claims")
+            self.claim_work = False
+        #watermarks are loaded when the crawl starts, during a rebuild they come from the empty staging tables. The
+        #stored game ids are loaded in scheduled_requests once the clubs due this run are known
+        self.watermarks = self.mydb.get_watermarks()
+        if self.recheck_days:
+            self.recheck_after = datetime.now() - timedelta(days=self.recheck_days)
+            self.content_hashes = self.mydb.get_content_hashes(self.recheck_after.date())
+
+    def club_list(self):
+        #start_urls plus settings/clubs.json, a list of club numbers or club result urls
+        clubs = list(self.start_urls)
+        if os.path.exists(self.clubs_file):
+            with open(self.clubs_file, 'r') as file:
+                clubs += json.load(file)
+        club_list = []
+        for club in clubs:
+            club_num = int(str(club).rstrip('/').split('/')[-1])
+            club_list.append((club_num, self.club_url.format(club_num)))
+        return club_list
 
-    def start_requests(self):
-        for url in self.start_urls:
-            yield scrapy.Request(url, callback=self.parse, errback=self.errback_http, headers=self.headerlist[0])
+    async def start(self):
+        #scrapy 2.13 and later start the crawl here and never call start_requests
+        for request in self.scheduled_requests():
+            yield request
 
+    def start_requests(self):
+        #older scrapy versions start from here
+        return self.scheduled_requests()
+
+    def scheduled_requests(self):
+        '''Registers the configured clubs and requests the listings of the clubs the ClubScheduler says are due'''
+        self.mydb.register_clubs(self.club_list())
+        self.scheduler = ClubScheduler(self.mydb, min_hours=self.min_poll_hours, max_hours=self.max_poll_hours)
+        if self.poll_all:
+            clubs = self.scheduler.due_clubs(now=datetime.max)
+        else:
+            clubs = self.scheduler.due_clubs(limit=self.max_clubs_per_run)
+        claimed = self.claim([f'club:{club_num}' for club_num, url in clubs])
+        self.stat('acbl/clubs_skipped/claimed', len(clubs) - len(claimed))
+        clubs = [(club_num, url) for club_num, url in clubs if f'club:{club_num}' in claimed]
+        print(f"Polling {len(clubs)} clubs")
+        #only the stored games of the clubs being polled, registry clubs included, an empty list would load every club
+        if clubs:
+            self.already_pulled |= self.mydb.get_game_list(club_nums=[club_num for club_num, url in clubs])
+        for club_num, url in clubs:
+            self.open_listings.add(club_num)
+            yield scrapy.Request(url, callback=self.parse, errback=self.errback_http, headers=self.headerlist[0],
+                                 meta={'club_num': club_num, 'scheduled': True, 'club_claim': f'club:{club_num}'})
+
+
+    def claim(self, keys):
+        #the keys this instance may work on, all of them when work claiming is off
+        if not self.claim_work:
+            return set(keys)
+        now = datetime.now().replace(microsecond=0)
+        return self.mydb.claim_work(keys, self.claim_owner, now + timedelta(minutes=self.claim_minutes), now)
+
+    def listed_game_done(self, club_num, game_id, written):
+        #called from the reactor and the writer threads once a game from a listing is written or has failed
+        with self.listing_lock:
+            game = self.listed_games.get(club_num, {}).get(game_id)
+            if game is not None and game[1] != 'written':
+                game[1] = 'written' if written else 'failed'
+
+    def safe_watermark(self, club_num, writing=None):
+        '''(club_num, game_id, date) of the newest game the watermark can move to, every game from the listing at or
+        before it is written (or is the game writing now, which commits the watermark in its own transaction).
+        None while the listing is still being read or when no game qualifies'''
+        with self.listing_lock:
+            if club_num in self.open_listings:
+                return None
+            games = self.listed_games.get(club_num, {})
+            blocked = [date for game_id, (date, state) in games.items() if state != 'written' and game_id != writing]
+            oldest_blocked = min(blocked) if blocked else None
+            done = [(date, game_id) for game_id, (date, state) in games.items()
+                    if (state == 'written' or game_id == writing) and (oldest_blocked is None or date < oldest_blocked)]
+        if not done:
+            return None
+        date, game_id = max(done)
+        return (club_num, game_id, date)
+
+    def release(self, keys):
+        #hands claimed keys back straight away, the owner is host:pid so the next run would not count as the same instance
+        keys = [key for key in keys if key]
+        if self.claim_work and keys:
+            self.mydb.release_work(keys, self.claim_owner)
+
+    def stat(self, key, value=1):
+        #counters and timings for the scrapy stats, MetricsExporter writes them out when the spider closes
+        if getattr(self, 'crawler', None) is not None:
+            self.crawler.stats.inc_value(key, value)
+
+    def record_fetch(self, response, page):
+        self.stat(f'acbl/fetch_count/{page}')
+        self.stat(f'acbl/fetch_seconds/{page}', response.meta.get('download_latency', 0))
+        self.stat(f'acbl/page_bytes/{page}', len(response.body))
 
     def parse(self, response):
         #Going through the clubs for only pairs
-        
+        self.record_fetch(response, 'listing')
+        club_num = response.meta.get('club_num')
+        watermark = self.watermarks.get(club_num)
+        found_new = False
+        reached_watermark = False
+        next_page = None
+        new_games = []
+
         for row in response.xpath('//tr[td[text()="PAIRS"]]'):
+            date_str = row.xpath('td/@data-sort').get()
+            event_date = datetime.fromtimestamp(int(date_str)) if date_str else None
             #adding a check for date limit so it doesn't come through everything again
-            if self.date_limit:
-                date_str = row.xpath('td/@data-sort').get()
-                event_date = datetime.fromtimestamp(int(date_str))
+            if self.date_limit and event_date:
                 age_in_days = (self.current_date - event_date).days
                 if age_in_days > self.max_data_age:
                     print("found old record "+ str(age_in_days))
+                    self.stat('acbl/games_skipped/date_limit')
                     break
-            game_not_found = True
             headers = random.choice(self.headerlist)
             result_link = row.xpath('.//a[contains(text(), "Results")]/@href').get()
+            if not result_link:
+                continue
             web_game_id = int(result_link.split('/')[-1])
             #find duplicate games and skip the work of finding it
-            for game in self.already_pulled:
-                if game == web_game_id:
-                    game_not_found = False
+            if web_game_id in self.already_pulled:
+                if watermark is None and event_date:
+                    #first visit since watermarks were added, start the club at its newest stored game. It is only
+                    #stored for a listing that came with its club number, the page still stops here either way
+                    watermark = (web_game_id, event_date)
+                    if club_num is not None:
+                        self.watermarks[club_num] = watermark
+                        self.mydb.update_watermark(club_num, web_game_id, event_date)
+                #the listing is newest first so everything past a stored game at the watermark is stored too
+                if watermark and (event_date is None or event_date <= watermark[1]):
+                    reached_watermark = True
+                if self.recheck_after and event_date and event_date >= self.recheck_after:
+                    #recent games are fetched again so corrections from the director are picked up
+                    self.stat('acbl/games_rechecked')
+                    yield response.follow(result_link, self.parse_result_page, errback=self.errback_http, headers=headers,
+                                          meta={'club_num': club_num, 'listing_date': event_date, 'recheck': True})
+                    continue
+                self.stat('acbl/games_skipped/already_stored')
+                if reached_watermark:
+                    print(f"reached watermark for club {club_num}")
+                    break
+                continue
+            found_new = True
+            new_games.append((f'game:{web_game_id}', result_link, headers, event_date))
+        else:
+            #the page ended before the watermark, there are more new games on the next page. A club with no
+            #watermark keeps going this way to backfill its older games
+            if not reached_watermark:
+                next_page = response.xpath(self.next_page_xpath).get()
+                if next_page:
+                    with self.listing_lock:
+                        self.open_listings.add(club_num)
+                    yield response.follow(next_page, self.parse, errback=self.errback_http, headers=self.headerlist[0],
+                                          meta={'club_num': club_num, 'club_claim': response.meta.get('club_claim')})
+
+        #the new games on the page are claimed together, a game another instance holds is left to it
+        claimed = self.claim([game[0] for game in new_games])
+        with self.listing_lock:
+            if not next_page:
+                self.open_listings.discard(club_num)
+            if club_num is not None:
+                #a game left to another instance stays pending too, it isn't known to be written
+                for claim_key, result_link, headers, event_date in new_games:
+                    self.listed_games.setdefault(club_num, {})[int(claim_key.split(':')[1])] = [event_date or datetime.min, 'pending']
+        for claim_key, result_link, headers, event_date in new_games:
+            if claim_key not in claimed:
+                self.stat('acbl/games_skipped/claimed')
+                continue
+            yield response.follow(result_link, self.parse_result_page, errback=self.errback_http, headers=headers,
+                                  meta={'club_num': club_num, 'listing_date': event_date, 'claim_key': claim_key,
+                                        'game_id': int(claim_key.split(':')[1])})
 
-            if result_link and game_not_found:
-                yield response.follow(result_link, self.parse_result_page, headers=headers)
+        if response.meta.get('scheduled'):
+            self.scheduler.record_poll(club_num, found_new)
+        #the club's listing lease goes with the last page that is read
+        if not next_page:
+            self.release([response.meta.get('club_claim')])
 
 
 
-    def parse_result_page(self, response):
+    async def parse_result_page(self, response):
+        self.record_fetch(response, 'result')
         # Check if the response has a successful status code
         if response.status == 200:
 
-            # Extract the JavaScript code containing the 'data' variable
-            script_code_match = re.search(r'var data = (.*?);', response.body.decode('utf-8'))
-            if script_code_match:
-                script_code = script_code_match.group(1)
-
-                # Load the data as a JSON object
-                data = json.loads(script_code)
-
-                #scub for the necessary data
-                id_value = int(data.get('id'))
-                skip = False
-                if self.already_pulled:
-                    for game in self.already_pulled:
-                        if id_value == game:
-                            skip = True
-                if not skip:
-                    self.add_data(data)
-
-
-                
+            # Extract the JavaScript code containing the 'data' variable and build the tables
+            try:
+                if self.parse_pool is not None:
+                    future = self.parse_pool.submit(parse_game_page, response.body, self.mydb.deal_format)
+                    id_value, payload, tables, timings = await maybe_deferred_to_future(deferred_from_future(future))
+                else:
+                    id_value, payload, tables, timings = parse_game_page(response.body, self.mydb.deal_format)
+            except ValueError as e:
+                self.logger.error(f"Unable to decode 'data' variable from {response.url}: {e}")
+                self.game_skipped(response, 'bad_json')
+                return
+            for stage, seconds in timings.items():
+                self.stat(f'acbl/stage_count/{stage}')
+                self.stat(f'acbl/stage_seconds/{stage}', seconds)
+            if id_value is not None:
+                self.logger.debug(f"Extracted {len(payload)} of {len(response.body)} bytes in {timings['extract'] * 1000:.1f}ms from {response.url}")
+
+                recheck = response.meta.get('recheck', False)
+                content_hash = tables['game_hash_data'].data['content_hash'][0]
+                if recheck and self.content_hashes.get(id_value) == content_hash:
+                    self.game_skipped(response, 'unchanged', stored=True)
+                elif recheck or id_value not in self.already_pulled:
+                    self.content_hashes[id_value] = content_hash
+                    yield GameItem(game_id=id_value, tables=tables, payload=payload, recheck=recheck and id_value in self.already_pulled,
+                                   club_num=response.meta.get('club_num'), listing_date=response.meta.get('listing_date'),
+                                   claim_key=response.meta.get('claim_key'))
+                else:
+                    self.game_skipped(response, 'already_stored', stored=True)
 
             else:
                 self.logger.error("Unable to find 'data' variable in the response")
+                self.game_skipped(response, 'no_data')
         else:
             self.logger.error(f"Received a non-200 status code: {response.status}")
+            self.game_skipped(response, 'http_status')
+
+    def game_skipped(self, response, reason, stored=False):
+        #a result page that ends without an item, a game already stored still counts as written for the watermark.
+        #Its claim is handed back here, only the pipeline finishes or releases the claim of a game it was given
+        self.stat(f'acbl/games_skipped/{reason}')
+        self.release([response.meta.get('claim_key')])
+        if response.meta.get('game_id'):
+            self.listed_game_done(response.meta.get('club_num'), response.meta['game_id'], stored)
+
+    def closed(self, reason):
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+        #writers racing each other can leave a watermark short of where it may go, it is settled once they are done
+        for club_num in list(self.listed_games):
+            watermark = self.safe_watermark(club_num)
+            if watermark:
+                self.mydb.update_watermark(*watermark)
 
     def add_data(self,data):
-        players_df = self.get_players(data)
-        club_df = self.get_club(data)
-        game_df = self.get_game_details(data)
-        section_df = self.get_section_data(data)
-        hand_record = self.get_hand_records(data) #this returns a dictionary for 2 tables
-        hand_results = self.get_hand_results(data)
-        game_results = self.get_game_results(data)
-        score_summary = self.get_score_summary(data)
-        self.mydb.upload_df_to_database(df=players_df,table_name='player_data',prim_key='acbl_num', date_check=True)
-        self.mydb.upload_df_to_database(df=club_df, table_name='club_data')
-        self.mydb.upload_df_to_database(df=game_df, table_name='game_data')
-        self.mydb.upload_df_to_database(df=section_df, table_name='section_data')
-        self.mydb.upload_df_to_database(df=hand_record['hand_record'], table_name='hand_records_data')
-        self.mydb.upload_df_to_database(df=hand_record['hand_expect'], table_name='hand_possibility_data')
-        self.mydb.upload_df_to_database(df=hand_results, table_name='hand_results_data')
-        self.mydb.upload_df_to_database(df=game_results, table_name='pair_results_data')
-        self.mydb.upload_df_to_database(df=score_summary, table_name='strat_result_summary_data')
+        #synchronous write, the crawl itself goes through GameWriterPipeline
+        if self.mydb.upload_game(self.build_tables(data)):
+            self.already_pulled.add(int(data['id']))
+            return True
+        return False
+
+    def build_tables(self,data):
+        return normalize_game(data, deal_format=self.mydb.deal_format)
 
     def errback_http(self, failure):
         # Handle HTTP errors and exceptions
+        self.stat(f'acbl/fetch_errors/{failure.type.__name__}')
+        #a listing or game that failed to download is handed back so a later run or another instance can try again
+        meta = failure.request.meta if getattr(failure, 'request', None) is not None else {}
+        self.release([meta.get('club_claim'), meta.get('claim_key')])
+        #a listing page that failed leaves its club open, the watermark can't move past games that were never read
+        if meta.get('game_id'):
+            self.listed_game_done(meta.get('club_num'), meta['game_id'], False)
         if failure.check(HttpError):
             response = failure.value.response
             self.logger.error(f"HTTP Error {response.status} occurred for URL: {response.url}")
@@ -274,349 +2184,106 @@ class ACBL_spider(scrapy.Spider):
     def handle_data(self,data):
         pass
 
+    #DataFrame views of single tables, the crawl itself writes straight from normalize_game
+    def normalized(self,data):
+        #the views of one game share a single normalize_game walk instead of one walk per table
+        if self.normalized_data is not data:
+            self.normalized_tables = normalize_game(data)
+            self.normalized_data = data
+        return self.normalized_tables
+
     def get_players(self,data):
-        #specific player data
-        player_list = []
-
-        sessions = data['sessions']
-        for session_num in range(len(sessions)):
-            sections = sessions[session_num]['sections']
-            for section_num in range(len(sections)):
-                pairs = sections[section_num]['pair_summaries']
-                for pair_num in range(len(pairs)):
-                    players = pairs[pair_num]['players']
-                    for player in players:
-                        player_list.append({
-                        'name': player['name'],
-                        'acbl_num': player['id_number'],
-                        'city': player['city'],
-                        'state': player['state'],
-                        'lifemaster': player['lifemaster'],
-                        'master_points': float(player['mp_total']) if player['mp_total'] is not None else 0.0,
-                        'bbo_username': player['bbo_username'],
-                        'last_updated': datetime.strptime(data['sessions'][0]['game_date'], "%Y-%m-%d %H:%M:%S").date() #used to make sure only the latest is updated
-                        })
-
-
-        print("Building Player Data for game..." + str(data['id']))
-        df = pd.DataFrame(player_list, columns=['name', 'acbl_num', 'city', 'state', 'lifemaster', 'master_points', 'bbo_username','last_updated'])
-        df['lifemaster'] = df['lifemaster'].fillna(0)
-        return df
+        return self.normalized(data)['player_data'].to_frame()
 
     def get_club(self,data):
-        club_list = []
-
-        club = data['club']
-        club_list.append({
-            'club_num': club['id'],
-            'club_name': club['name'],
-            'unit_num': club['unit_no'],
-            'district_num': club['district_no'],
-            'manager_num': club['manager_no'],
-            'alias': club['alias']
-        })
-        print("Building Club Data")
-        df = pd.DataFrame(club_list, columns=['club_num', 'club_name','unit_num','district_num','manager_num','alias'])
-        return df
-
+        return self.normalized(data)['club_data'].to_frame()
 
     def get_game_details(self,data):
-        game_detail_list = []
-
-        section_count = 0
-        for section_num in range(len(data['sessions'])):
-            section_count += int(data['sessions'][section_num]['number_of_sections'])
-
-        game_detail_list.append({
-            'game_id': data['id'],
-            'game_name': data['name'],
-            'game_rating': data['rating'],
-            'club_num': data['club_id_number'],
-            'game_type': data['type'],
-            'scoring_method': data['board_scoring_method'],
-            'start_date': datetime.strptime(data['start_date'],"%m/%d/%Y").date(),
-            'end_date': datetime.strptime(data['end_date'],"%m/%d/%Y").date(),
-            'session_cnt': data['number_of_sessions'],
-            'section_cnt': section_count
-        })
-
-        print("Building Game Data")
-        df = pd.DataFrame(game_detail_list, columns=['game_id', 'game_name', 'game_rating','club_num','game_type','scoring_method','start_date','end_date','session_cnt','section_cnt'])
-        return df
+        return self.normalized(data)['game_data'].to_frame()
 
     def get_section_data(self,data):
-    #collapsing the session and section data into one table
-        section_detail_list = []
-        sessions = data['sessions']
-
-        for session_num in range(len(sessions)):
-            sections = sessions[session_num]['sections']
-            hand_record_id = sessions[session_num]['hand_record_id']
-            for section_num in range(len(sections)):
-                section_detail_list.append({
-                    'section_id': sections[section_num]['id'],
-                    'game_id': data['id'],
-                    'session_id': sections[section_num]['session_id'], #usually the same as the game_id
-                    'section_name': sections[section_num]['name'],
-                    'hand_record': hand_record_id,
-                    'boards_per': sections[section_num]['boards_per_round'],
-                    'round_count': sections[section_num]['number_of_rounds'],
-                    'pair_count': len(sections[section_num]['pair_summaries'])    
-                }
-                )
-        print("Building Section Data")
-        df = pd.DataFrame(section_detail_list,columns=['section_id','game_id','session_id','section_name','hand_record','boards_per','round_count','pair_count'])
-        return df
-    
-    def get_hand_records(self,data):
-        hand_record_details = []
-        hand_expectation = []
-        sessions = data['sessions']
-        
-        for session_num in range(len(sessions)):
-            session_id = sessions[session_num]['id']
-            hand_records = sessions[session_num]['hand_records']
-            hand_record_id = sessions[session_num]['hand_record_id']
-            for hand_num in range(len(hand_records)):
-                board_num_id = None
-                #get board id from the board results
-                for board_num in range(len(sessions[session_num]['sections'][0]['boards'])):
-                    if hand_records[hand_num]['board'] == sessions[session_num]['sections'][0]['boards'][board_num]['board_number']:
-                        board_num_id = sessions[session_num]['sections'][0]['boards'][board_num]['id']
-                hand_record_details.append({
-                    'hand_id': hand_records[hand_num]['id'],
-                    'hand_record': hand_record_id,
-                    'board': hand_records[hand_num]['board'],
-                    'board_id_num': board_num_id,
-                    'direction': 'N',
-                    'spades': hand_records[hand_num]['north_spades'],
-                    'hearts': hand_records[hand_num]['north_hearts'],
-                    'diamonds': hand_records[hand_num]['north_diamonds'],
-                    'clubs': hand_records[hand_num]['north_clubs'],
-                })
-                hand_record_details.append({
-                    'hand_id': hand_records[hand_num]['id'],
-                    'hand_record': hand_record_id,
-                    'board': hand_records[hand_num]['board'],
-                    'board_id_num': board_num_id,
-                    'direction': 'S',
-                    'spades': hand_records[hand_num]['south_spades'],
-                    'hearts': hand_records[hand_num]['south_hearts'],
-                    'diamonds': hand_records[hand_num]['south_diamonds'],
-                    'clubs': hand_records[hand_num]['south_clubs'],
-                })
-                hand_record_details.append({
-                    'hand_id': hand_records[hand_num]['id'],
-                    'hand_record': hand_record_id,
-                    'board': hand_records[hand_num]['board'],
-                    'board_id_num': board_num_id,
-                    'direction': 'E',
-                    'spades': hand_records[hand_num]['east_spades'],
-                    'hearts': hand_records[hand_num]['east_hearts'],
-                    'diamonds': hand_records[hand_num]['east_diamonds'],
-                    'clubs': hand_records[hand_num]['east_clubs'],
-                })
-                hand_record_details.append({
-                    'hand_id': hand_records[hand_num]['id'],
-                    'hand_record': hand_record_id,
-                    'board': hand_records[hand_num]['board'],
-                    'board_id_num': board_num_id,
-                    'direction': 'W',
-                    'spades': hand_records[hand_num]['west_spades'],
-                    'hearts': hand_records[hand_num]['west_hearts'],
-                    'diamonds': hand_records[hand_num]['west_diamonds'],
-                    'clubs': hand_records[hand_num]['west_clubs'],
-                })
-                hand_expectation.append({
-                    'hand_id': hand_records[hand_num]['id'],
-                    'hand_record': hand_record_id,
-                    'board': hand_records[hand_num]['board'],
-                    'board_id_num': board_num_id,
-                    'dealer':hand_records[hand_num]['dealer'],
-                    'vulnerability':hand_records[hand_num]['vulnerability'],
-                    'double_dummy_ew':hand_records[hand_num]['double_dummy_ew'],
-                    'double_dummy_ns':hand_records[hand_num]['double_dummy_ns'],
-                    'par':hand_records[hand_num]['par']
-
-                })
-
-        df_hr = pd.DataFrame(hand_record_details,columns=['hand_id','hand_record','board','board_id_num','direction','spades','hearts','diamonds','clubs'])
-        #reformat to get better data, remove spaces and turn 10 into T so it is only one character
-        df_hr['spades'] = df_hr['spades'].str.replace('10', 'T').str.replace(' ', '')
-        df_hr['hearts'] = df_hr['hearts'].str.replace('10', 'T').str.replace(' ', '')
-        df_hr['diamonds'] = df_hr['diamonds'].str.replace('10', 'T').str.replace(' ', '')
-        df_hr['clubs'] = df_hr['clubs'].str.replace('10', 'T').str.replace(' ', '')
-        
-        df_hr['board_id_num'] = df_hr['board_id_num'].fillna(0)
-        df_hr = df_hr.dropna(subset=['hand_record'])
-        df_hr = df_hr[df_hr['hand_record'] != 'SHUFFLE']
-
-        df_hexp = pd.DataFrame(hand_expectation, columns=['hand_id','hand_record','board','board_id_num','dealer','vulnerability','double_dummy_ew','double_dummy_ns','par'])
-        df_hexp['board_id_num'] = df_hexp['board_id_num'].fillna(0)
-        df_hexp = df_hexp.dropna(subset=['hand_record'])
-        df_hexp = df_hexp[df_hexp['hand_record'] != 'SHUFFLE']
-        return {'hand_record':df_hr,'hand_expect':df_hexp}
+        return self.normalized(data)['section_data'].to_frame()
 
+    def get_hand_records(self,data):
+        tables = self.normalized(data)
+        return {'hand_record':tables['hand_records_data'].to_frame(),'hand_expect':tables['hand_possibility_data'].to_frame()}
 
     def get_game_results(self,data):
-        game_results_details = []
-        sessions = data['sessions']
-        add_pair_direction = False
-
-        for session_num in range(len(sessions)):
-            session_id = sessions[session_num]['id']
-            sections = sessions[session_num]['sections']
-            for section_num in range(len(sections)):
-                section_id = sections[section_num]['id']
-                pair_summaries = sections[section_num]['pair_summaries']
-                if sections[section_num]['pair_summaries'][0]['direction']:
-                    add_pair_direction = True
-                else:
-                    add_pair_direction = False
-                for pair_num in range(len(pair_summaries)):
-                    if add_pair_direction:
-                        pair = pair_summaries[pair_num]['pair_number'] + pair_summaries[pair_num]['direction']
-                    else:
-                        pair = pair_summaries[pair_num]['pair_number']
-                    pair_summary_id = pair_summaries[pair_num]['id']
-                    score = pair_summaries[pair_num]['score']
-                    percentage = pair_summaries[pair_num]['percentage']
-                    players = pair_summaries[pair_num]['players']
-                    for player_num in range(len(players)):
-                        direction = None
-                        if len(players[player_num]['awards_score'])> 0:
-                            mp = players[player_num]['awards_score'][0]['total']
-                        else:
-                            mp = None
-                        
-                        #set default direction for the pair
-                        if add_pair_direction:
-                            if pair_summaries[pair_num]['direction'] == 'NS':
-                                if pair_num == 0:
-                                    direction = 'N'
-                                else:
-                                    direction = 'S'
-                            else:
-                                if pair_num != 0:
-                                    direction = 'E'
-                                else:
-                                    direction = 'W'
-                        else:
-                            direction = None
-
-                        game_results_details.append({
-                            'pair_id_num': pair_summary_id,
-                            'session_id': session_id,
-                            'section_id':section_id,
-                            'acbl_num': players[player_num]['id_number'],
-                            'pair': pair,
-                            'score': score,
-                            'percentage': percentage,
-                            'mp_earned': mp,
-                            'direction': direction
-                        })
-        df = pd.DataFrame(game_results_details,columns=['pair_id_num','session_id','section_id','acbl_num','pair','score','percentage','mp_earned','direction'])
-        #add some random easy identifiable numbers if there is no acbl number
-        df['percentage'] = df['percentage'].fillna(0)
-        return df
+        return self.normalized(data)['pair_results_data'].to_frame()
 
     def get_hand_results(self,data):
-        board_results_details = []
-        sessions = data['sessions']
-        add_pair_direction = False
-        
-        for session_num in range(len(sessions)):
-            session_id = sessions[session_num]['id']
-            hand_record_id = sessions[session_num]['hand_record_id']  
-            sections = sessions[session_num]['sections']
-            for section_num in range(len(sections)):
-                section_id = sections[section_num]['id']
-                boards = sections[section_num]['boards']
-                if sections[section_num]['pair_summaries'][0]['direction']:
-                    add_pair_direction = True
-                else:
-                    add_pair_direction = False
-                for board_num in range(len(boards)):
-                    results = boards[board_num]['board_results']
-                    board_num = boards[board_num]['board_number']
-                    for result_num in range(len(results)):
-                        if add_pair_direction:
-                            ns_pair = results[result_num]['ns_pair'] + 'NS'
-                            ew_pair = results[result_num]['ew_pair'] + 'EW'
-                        else:
-                            ns_pair = results[result_num]['ns_pair'] 
-                            ew_pair = results[result_num]['ew_pair']
-
-                        board_results_details.append({
-                            'result_id': results[result_num]['id'],
-                            'session_id':session_id,
-                            'hand_record':hand_record_id,
-                            'section_id':section_id,
-                            'board_id':results[result_num]['board_id'],
-                            'board_num': board_num,
-                            'round_num': results[result_num]['round_number'],
-                            'table_num': results[result_num]['table_number'],
-                            'ns_pair':ns_pair,
-                            'ew_pair':ew_pair,
-                            'ns_score':results[result_num]['ns_score'],
-                            'ew_score':results[result_num]['ew_score'],
-                            'contract':results[result_num]['contract'],
-                            'declarer':results[result_num]['declarer'],
-                            'ew_match_points':results[result_num]['ew_match_points'],
-                            'ns_match_points':results[result_num]['ns_match_points'],
-                            'opening_lead':results[result_num]['opening_lead'],
-                            'result':results[result_num]['result'],
-                            'tricks_taken':results[result_num]['tricks_taken']
-
-                        })
-
-        df = pd.DataFrame(board_results_details,columns=['result_id','session_id','hand_record','section_id','board_id','board_num','round_num','table_num','ns_pair','ew_pair','ns_score','ew_score','contract','declarer','ew_match_points','ns_match_points','opening_lead','result','tricks_taken'])
-        df['result'] = df['result'].str.replace('=', '0')
-        #hasn't been tested
-        df.replace('', None, inplace=True)
-        #shoudl be some nulls in results when there are weird adjustments
-        df['ns_score'] = df['ns_score'].str.replace('PASS','0')
-        df['ew_score'] = df['ew_score'].str.replace('PASS','0')
-        df = df.dropna(subset=['round_num','hand_record'])
-        df = df[df['hand_record'] != 'SHUFFLE']
-        return df
+        return self.normalized(data)['hand_results_data'].to_frame()
 
     def get_score_summary(self,data):
-        score_results_details = []
-        sessions = data['sessions']
-
-        for session_num in range(len(sessions)):
-            sections = sessions[session_num]['sections']
-            for section_num in range(len(sections)):
-                pair_summaries = sections[section_num]['pair_summaries']
-                for pair_num in range(len(pair_summaries)):
-                    pair_summary_id = pair_summaries[pair_num]['id']
-                    strats = pair_summaries[pair_num]['strat_place']
-                    for strat_num in range(len(strats)):
-                        score_results_details.append({
-                            'strat_id':strats[strat_num]['id'],
-                            'pair_id_num':pair_summary_id,
-                            'strat_num':strats[strat_num]['strat_number'],
-                            'rank':strats[strat_num]['rank'],
-                            'strat_type':strats[strat_num]['type']
-                        })
-        df = pd.DataFrame(score_results_details,columns=['strat_id','pair_id_num','strat_num','rank','strat_type'])
-        return df
+        return self.normalized(data)['strat_result_summary_data'].to_frame()
 
 
 if __name__ == "__main__":
     date_limit = False
     delete = False
+    replay = False
+    poll_all = False
+    workers = None
+    parse_workers = 0
+    recheck_days = 0
+    claim_work = False
+    rebuild_aggregates = False
+    partition_results = False
 
     if '--date_limit' in sys.argv:
         date_limit = True
     if '--rebuild' in sys.argv:
         delete = True
-
-    #purge if the argument was passed
+    if '--replay' in sys.argv:
+        replay = True
+    if '--poll_all' in sys.argv:
+        poll_all = True
+    if '--workers' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    if '--parse_workers' in sys.argv:
+        parse_workers = int(sys.argv[sys.argv.index('--parse_workers') + 1])
+    if '--claim_work' in sys.argv:
+        claim_work = True
+    if '--rebuild_aggregates' in sys.argv:
+        rebuild_aggregates = True
+    if '--partition_results' in sys.argv:
+        partition_results = True
+    if '--recheck_days' in sys.argv:
+        recheck_days = int(sys.argv[sys.argv.index('--recheck_days') + 1])
+
+    if claim_work and not shared_database().supports_claims:
+        print(f"--claim_work needs a sql database, {shared_database().cred_data['system']} can't share a crawl, running without it")
+        claim_work = False
+    #a rebuild loads into staging tables, the live tables keep serving until the swap at the end
     if delete:
-        data = DatabasePipeline()
-        data.purge_db_contents()
-    process = CrawlerProcess()
-    process.crawl(ACBL_spider,date_limit=date_limit)
-    process.start()
\ No newline at end of file
+        StorageBackend.staging = True
+        shared_database().create_staging_tables()
+    #why a rebuild is left in staging, a partial rebuild must never replace the live tables
+    keep_staging = None
+    if replay:
+        #rebuild from the local archive instead of crawling
+        failed = replay_archive(shared_database().archive_dir, workers=workers)
+        if failed:
+            keep_staging = f"{len(failed)} archived games failed to replay"
+    elif rebuild_aggregates:
+        #only the player aggregates, from the results already stored
+        shared_database().rebuild_player_aggregates()
+    elif partition_results and not delete:
+        shared_database().partition_result_tables()
+    else:
+        process = CrawlerProcess()
+        crawler = process.create_crawler(ACBL_spider)
+        process.crawl(crawler,date_limit=date_limit,poll_all=poll_all or delete,parse_workers=parse_workers,recheck_days=recheck_days,
+                      claim_work=claim_work and not delete)
+        process.start()
+        finish_reason = crawler.stats.get_value('finish_reason')
+        if finish_reason != 'finished':
+            keep_staging = f"the crawl closed with reason {finish_reason}"
+    #parquet partitions are merged into a few large files, nothing to do for the sql databases
+    shared_database().compact()
+    if delete and keep_staging:
+        print(f"Leaving the rebuild in the staging tables, {keep_staging}. The live tables are unchanged, run --rebuild again")
+    elif delete:
+        shared_database().swap_staging_tables()
+        if partition_results:
+            shared_database().partition_result_tables()
@@ -0,0 +1,363 @@
+'''Read side analytics over the tables filled by acbl-live_scraper.py.
+
+The scoring engine recomputes board scores from hand_results_data with pandas/numpy, grouped by section and board,
+so the matchpoints taken from the website can be checked and a game can be rescored as IMPs or Butler.
+Run it as a script for the nightly consistency check:
+    python acbl_analytics.py --check [--since 2024-01-01] [--club 261750]
+
+ResultsStore is the way to read the tables back into pandas for notebooks and reports, with compact dtypes and an
+on-disk cache.
+'''
+
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from bridge_hands import DD_COLUMNS, SEATS, STRAINS, STRAIN_NAMES, double_dummy_array
+
+
+BOARD_KEYS = ['section_id', 'board_id']
+#score difference at which each IMP starts, 20-40 is 1 IMP up to 4000+ which is 24
+IMP_TABLE = np.array([20, 50, 90, 130, 170, 220, 270, 320, 370, 430, 500, 600, 750, 900, 1100, 1300, 1500, 1750, 2000, 2250, 2500, 3000, 3500, 4000])
+
+
+def connect(settings_file=os.path.join('settings', 'db.json')):
+    #same db.json as the scraper, the queries here are sql so only the sql backends can be read
+    with open(settings_file, 'r') as file:
+        cred_data = json.load(file)
+    if cred_data['system'] == 'sqlite':
+        return sqlite3.connect(cred_data['database'], detect_types=sqlite3.PARSE_DECLTYPES)
+    if cred_data['system'] == 'parquet':
+        raise ValueError(f"acbl_analytics does not support the parquet backend, read {cred_data['database']} with pyarrow.dataset instead")
+    import mariadb
+    return mariadb.connect(
+        user=cred_data['user'],
+        password=cred_data['password'],
+        host=cred_data['host'],
+        port=cred_data['port'],
+        database=cred_data['database']
+    )
+
+
+def filter_games(sql, params=None, club_num=None, since=None, until=None, acbl_num=None):
+    '''Adds the club, date range and player filters on the game (aliased g) to sql, returns (sql, params).
+    Filtering on the game lets every query narrow through the game_data(club_num, start_date) index'''
+    params = list(params or [])
+    filters = []
+    if club_num:
+        filters.append('g.club_num = ?')
+        params.append(club_num)
+    if since:
+        filters.append('g.start_date >= ?')
+        params.append(since)
+    if until:
+        filters.append('g.start_date <= ?')
+        params.append(until)
+    if acbl_num:
+        filters.append('g.game_id IN (SELECT s2.game_id FROM pair_results_data p2 JOIN section_data s2 ON s2.section_id = p2.section_id WHERE p2.acbl_num = ?)')
+        params.append(acbl_num)
+    if filters:
+        sql += (' AND ' if 'WHERE' in sql else ' WHERE ') + ' AND '.join(filters)
+    return sql, tuple(params)
+
+
+def load_hand_results(conn, since=None, club_num=None):
+    '''hand_results_data rows for the scoring engine, optionally only games from a date onward or from one club'''
+    sql = '''
+    SELECT hr.section_id, hr.board_id, hr.ns_pair, hr.ew_pair, hr.ns_score, hr.ew_score, hr.ns_match_points, hr.ew_match_points
+    FROM hand_results_data hr
+    JOIN section_data s ON s.section_id = hr.section_id
+    JOIN game_data g ON g.game_id = s.game_id
+    '''
+    sql, params = filter_games(sql, club_num=club_num, since=since)
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    columns = ['section_id', 'board_id', 'ns_pair', 'ew_pair', 'ns_score', 'ew_score', 'ns_match_points', 'ew_match_points']
+    df = pd.DataFrame(cur.fetchall(), columns=columns)
+    for column in ['ns_score', 'ew_score', 'ns_match_points', 'ew_match_points']:
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    return df
+
+
+def load_pair_results(conn, since=None, club_num=None):
+    '''pair percentages from pair_results_data, limited to the same games as load_hand_results'''
+    sql = '''
+    SELECT DISTINCT p.section_id, p.pair, p.percentage
+    FROM pair_results_data p
+    JOIN section_data s ON s.section_id = p.section_id
+    JOIN game_data g ON g.game_id = s.game_id
+    '''
+    sql, params = filter_games(sql, club_num=club_num, since=since)
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    df = pd.DataFrame(cur.fetchall(), columns=['section_id', 'pair', 'percentage'])
+    df['percentage'] = pd.to_numeric(df['percentage'], errors='coerce')
+    return df
+
+
+#dtypes ResultsStore gives the columns, the rest are left as pandas reads them
+COMPACT_DTYPES = {
+    'board_num': 'int8', 'round_num': 'int8', 'table_num': 'int8', 'result': 'int8', 'tricks_taken': 'int8',
+    'game_rating': 'int8', 'session_cnt': 'int8', 'section_cnt': 'int8',
+    'ns_score': 'int16', 'ew_score': 'int16',
+    'ns_match_points': 'float32', 'ew_match_points': 'float32', 'score': 'float32', 'percentage': 'float32', 'mp_earned': 'float32',
+    'direction': pd.CategoricalDtype(list(SEATS)), 'declarer': pd.CategoricalDtype(list(SEATS)), 'strain': pd.CategoricalDtype(list(STRAINS)),
+    'game_type': 'category', 'scoring_method': 'category', 'ns_pair': 'category', 'ew_pair': 'category', 'pair': 'category',
+    'hand_record': 'category', 'contract': 'category', 'opening_lead': 'category',
+}
+
+
+class ResultsStore():
+    '''Loads games, board results and pair results by club, date range or player as DataFrames with compact dtypes,
+    small ints for board/round/table numbers and categoricals for the repeated strings.
+    Every query is cached under cache_dir as a pickle stamped with the count and newest hashed_at of game_hash_data,
+    so it is read back from disk until a game is ingested or corrected'''
+
+    def __init__(self, conn=None, cache_dir='cache'):
+        self.conn = conn or connect()
+        self.cache_dir = cache_dir
+        #part of every cache key so stores on different databases sharing a cache_dir never read each other's frames
+        self.database = database_identity(self.conn)
+
+    def games(self, club_num=None, since=None, until=None, acbl_num=None):
+        '''game_data rows with the club name'''
+        sql = '''
+        SELECT g.game_id, g.club_num, c.club_name, g.game_name, g.game_type, g.scoring_method, g.game_rating,
+            g.start_date, g.end_date, g.session_cnt, g.section_cnt
+        FROM game_data g
+        LEFT JOIN club_data c ON c.club_num = g.club_num
+        '''
+        return self.query(sql, club_num, since, until, acbl_num)
+
+    def boards(self, club_num=None, since=None, until=None, acbl_num=None):
+        '''hand_results_data rows, one per board played, with the game and the strain of the contract'''
+        sql = '''
+        SELECT g.game_id, g.start_date, hr.section_id, hr.board_id, hr.hand_record, hr.board_num, hr.round_num, hr.table_num,
+            hr.ns_pair, hr.ew_pair, hr.contract, hr.declarer, hr.opening_lead, hr.result, hr.tricks_taken,
+            hr.ns_score, hr.ew_score, hr.ns_match_points, hr.ew_match_points
+        FROM hand_results_data hr
+        JOIN section_data s ON s.section_id = hr.section_id
+        JOIN game_data g ON g.game_id = s.game_id
+        '''
+        return self.query(sql, club_num, since, until, acbl_num, strain=True)
+
+    def results(self, club_num=None, since=None, until=None, acbl_num=None):
+        '''pair_results_data rows, one per player, only the player's own rows when acbl_num is given'''
+        sql = '''
+        SELECT g.game_id, g.start_date, p.section_id, p.pair_id_num, p.pair, p.acbl_num, p.direction, p.score, p.percentage, p.mp_earned
+        FROM pair_results_data p
+        JOIN section_data s ON s.section_id = p.section_id
+        JOIN game_data g ON g.game_id = s.game_id
+        '''
+        if acbl_num:
+            sql += ' WHERE p.acbl_num = ?'
+            return self.query(sql, club_num, since, until, params=[acbl_num])
+        return self.query(sql, club_num, since, until)
+
+    def query(self, sql, club_num=None, since=None, until=None, acbl_num=None, strain=False, params=None):
+        sql, params = filter_games(sql, params, club_num, since, until, acbl_num)
+        stamp = self.ingest_stamp()
+        key = hashlib.sha1(repr((self.database, sql, params, strain)).encode()).hexdigest()
+        path = os.path.join(self.cache_dir, f'{key}.pkl')
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                cached = pickle.load(file)
+            if cached['stamp'] == stamp:
+                return cached['frame']
+
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        df = pd.DataFrame(cur.fetchall(), columns=[column[0] for column in cur.description])
+        if strain:
+            df['strain'] = df['contract'].str.extract(r'^[1-7](NT|[CDHSN])', expand=False).map(STRAIN_NAMES)
+        df = compact(df)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as file:
+            pickle.dump({'stamp': stamp, 'frame': df}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        return df
+
+    def ingest_stamp(self):
+        #every ingested or corrected game writes a game_hash_data row, so a new game or a correction changes this
+        cur = self.conn.cursor()
+        cur.execute('SELECT COUNT(*), MAX(hashed_at) FROM game_hash_data')
+        count, newest = cur.fetchone()
+        return (count, str(newest))
+
+    def clear_cache(self):
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+def database_identity(conn):
+    #the database file for sqlite, the server and schema for mariadb
+    cur = conn.cursor()
+    if isinstance(conn, sqlite3.Connection):
+        cur.execute('PRAGMA database_list')
+        file = cur.fetchone()[2]
+        return ('sqlite', os.path.abspath(file) if file else ':memory:')
+    cur.execute('SELECT @@hostname, @@port, DATABASE()')
+    return ('mariadb',) + tuple(cur.fetchone())
+
+
+def compact(df):
+    '''Converts the columns named in COMPACT_DTYPES, an int column with missing values gets the nullable Int type'''
+    for column, dtype in COMPACT_DTYPES.items():
+        if column not in df.columns:
+            continue
+        if isinstance(dtype, str) and dtype.startswith(('int', 'float')):
+            values = pd.to_numeric(df[column], errors='coerce')
+            df[column] = values.astype(dtype if dtype.startswith('float') or values.notna().all() else dtype.capitalize())
+        else:
+            df[column] = df[column].astype(dtype)
+    for column in ('start_date', 'end_date'):
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column])
+    return df
+
+
+def ns_net_score(df):
+    #one of ns_score and ew_score is the score, the other is 0 or empty
+    return df['ns_score'].fillna(0).to_numpy(dtype=np.int64) - df['ew_score'].fillna(0).to_numpy(dtype=np.int64)
+
+
+def to_imps(diff):
+    diff = np.asarray(diff)
+    return np.sign(diff) * np.searchsorted(IMP_TABLE, np.abs(diff), side='right')
+
+
+def matchpoints(df):
+    '''Matchpoints on the ACBL scale, 1 for every result beaten and a half for every tie on the same board.
+    Returns a DataFrame of ns_mp and ew_mp aligned with df'''
+    net = pd.Series(ns_net_score(df), index=df.index)
+    groups = net.groupby([df[key] for key in BOARD_KEYS])
+    ns_mp = groups.rank(method='average') - 1
+    top = groups.transform('size') - 1
+    return pd.DataFrame({'ns_mp': ns_mp, 'ew_mp': top - ns_mp, 'top': top}, index=df.index)
+
+
+def cross_imps(df):
+    '''Average IMPs against every other result on the same board'''
+    left = df[BOARD_KEYS].copy()
+    left['net'] = ns_net_score(df)
+    left['row'] = np.arange(len(df))
+    pairs = left.merge(left, on=BOARD_KEYS, suffixes=('', '_other'))
+    pairs = pairs[pairs['row'] != pairs['row_other']]
+    pairs['imps'] = to_imps(pairs['net'].to_numpy() - pairs['net_other'].to_numpy())
+    ns_imps = pairs.groupby('row')['imps'].mean().reindex(np.arange(len(df)), fill_value=0.0).to_numpy()
+    return pd.DataFrame({'ns_imps': ns_imps, 'ew_imps': -ns_imps}, index=df.index)
+
+
+def butler(df):
+    '''IMPs against the board datum, the average score with the top and bottom left out once there are five results,
+    rounded to the nearest 10'''
+    net = pd.Series(ns_net_score(df), index=df.index)
+    groups = net.groupby([df[key] for key in BOARD_KEYS])
+    count = groups.transform('size')
+    total = groups.transform('sum')
+    trimmed = (total - groups.transform('max') - groups.transform('min')) / (count - 2).where(count >= 5)
+    datum = (trimmed.fillna(total / count) / 10).round() * 10
+    ns_imps = to_imps(net.to_numpy() - datum.to_numpy())
+    return pd.DataFrame({'ns_imps': ns_imps, 'ew_imps': -ns_imps, 'datum': datum}, index=df.index)
+
+
+def rescore(df, method='matchpoints'):
+    if method == 'matchpoints':
+        return matchpoints(df)
+    elif method == 'imps':
+        return cross_imps(df)
+    elif method == 'butler':
+        return butler(df)
+    raise ValueError(f'Unknown scoring method {method}')
+
+
+def pair_percentages(df, scores=None):
+    '''Rolls matchpoints up to a percentage per section and pair, pair names match pair_results_data.pair'''
+    if scores is None:
+        scores = matchpoints(df)
+    ns = pd.DataFrame({'section_id': df['section_id'], 'pair': df['ns_pair'], 'mp': scores['ns_mp'], 'top': scores['top']})
+    ew = pd.DataFrame({'section_id': df['section_id'], 'pair': df['ew_pair'], 'mp': scores['ew_mp'], 'top': scores['top']})
+    totals = pd.concat([ns, ew], ignore_index=True).groupby(['section_id', 'pair'], as_index=False)[['mp', 'top']].sum()
+    totals['percentage'] = 100 * totals['mp'] / totals['top'].where(totals['top'] > 0)
+    return totals
+
+
+def compare_matchpoints(df, scores=None, tolerance=0.01):
+    '''Results whose matchpoints from the website differ from the recomputed ones'''
+    if scores is None:
+        scores = matchpoints(df)
+    diff = (df['ns_match_points'] - scores['ns_mp']).abs()
+    return df.assign(computed_ns_mp=scores['ns_mp'], ns_mp_diff=diff)[diff > tolerance]
+
+
+def compare_percentages(computed, pair_results, tolerance=0.1):
+    '''Pairs whose pair_results_data.percentage is more than tolerance away from the recomputed percentage'''
+    merged = computed.merge(pair_results, on=['section_id', 'pair'], how='inner', suffixes=('_computed', '_reported'))
+    merged['diff'] = merged['percentage_computed'] - merged['percentage_reported']
+    return merged[merged['diff'].abs() > tolerance]
+
+
+def load_double_dummy(conn, hand_record=None):
+    '''Double dummy tricks from hand_dd_data as (hand_ids, tricks), tricks is an (n_boards, 4, 5) int8 array by
+    declarer (NESW) and strain (CDHSN) with -1 where the hand record had no double dummy'''
+    sql = 'SELECT hand_id, ' + ', '.join(DD_COLUMNS) + ' FROM hand_dd_data'
+    params = ()
+    if hand_record:
+        sql += ' WHERE hand_id IN (SELECT hand_id FROM hand_possibility_data WHERE hand_record = ?)'
+        params = (hand_record,)
+    sql += ' ORDER BY hand_id'
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    results = cur.fetchall()
+    hand_ids = np.array([result[0] for result in results], dtype=np.int64)
+    return hand_ids, double_dummy_array([result[1:] for result in results])
+
+
+def tricks_vs_double_dummy(tricks, board_rows, declarer, contract, tricks_taken):
+    '''Tricks taken minus double dummy tricks for a batch of results in one go.
+    board_rows indexes each result into tricks, declarer is the seat letter and contract like '4S' or '3NTx'.
+    Results with no contract or no double dummy come back as NaN'''
+    seat_idx = pd.Series(declarer).map({seat: num for num, seat in enumerate(SEATS)})
+    strain = pd.Series(contract).str.extract(r'^[1-7](NT|[CDHSN])', expand=False).map(STRAIN_NAMES)
+    strain_idx = strain.map({name: num for num, name in enumerate(STRAINS)})
+    valid = (seat_idx.notna() & strain_idx.notna()).to_numpy()
+    expected = np.full(len(valid), -1, dtype=np.int16)
+    rows = np.asarray(board_rows)[valid]
+    expected[valid] = tricks[rows, seat_idx[valid].astype(int).to_numpy(), strain_idx[valid].astype(int).to_numpy()]
+    diff = pd.to_numeric(pd.Series(tricks_taken), errors='coerce').to_numpy(dtype=float) - expected
+    diff[expected < 0] = np.nan
+    return diff
+
+
+def consistency_check(conn, since=None, club_num=None):
+    start = datetime.now()
+    df = load_hand_results(conn, since=since, club_num=club_num)
+    scores = matchpoints(df)
+    bad_results = compare_matchpoints(df, scores)
+    bad_pairs = compare_percentages(pair_percentages(df, scores), load_pair_results(conn, since=since, club_num=club_num))
+    print(f"Checked {len(df)} results in {(datetime.now() - start).total_seconds():.1f}s")
+    print(f"{len(bad_results)} results with different matchpoints, {len(bad_pairs)} pairs with a different percentage")
+    return bad_results, bad_pairs
+
+
+if __name__ == "__main__":
+    since = None
+    club_num = None
+    if '--since' in sys.argv:
+        since = datetime.strptime(sys.argv[sys.argv.index('--since') + 1], '%Y-%m-%d').date()
+    if '--club' in sys.argv:
+        club_num = int(sys.argv[sys.argv.index('--club') + 1])
+    if '--check' in sys.argv:
+        bad_results, bad_pairs = consistency_check(connect(), since=since, club_num=club_num)
+        if len(bad_pairs):
+            print(bad_pairs.to_string(index=False))
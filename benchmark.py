@@ -0,0 +1,301 @@
+'''End to end ingest benchmark, a result page in and committed rows out, against a throwaway sqlite database.
+
+Three page sizes are measured, a one section club game, a multi section game and a multi session event. A page recorded
+from the website is used when fixtures/<name>.html exists, otherwise a synthetic page of the same shape is generated.
+No recorded pages are committed. The synthetic ones are built from the fields normalize_game reads and were never
+checked against a live page, fields the site sends that the scraper ignores and its real string lengths are missing, so
+their numbers compare runs with each other rather than predict the crawl.
+    python benchmark.py                          run every fixture and print the report
+    python benchmark.py --record club <url>      save a real result page as the club fixture
+    python benchmark.py --save_baseline          keep the numbers in fixtures/baseline.json
+    python benchmark.py --threshold 0.2          exit 1 if a fixture is more than 20% slower than the baseline, the first
+                                                 run on a machine has no baseline yet and saves one instead
+    python benchmark.py --dataframes             write each table through get_* and upload_df_to_database instead of upload_game
+Under the stage totals the report breaks the upload down by table, and with --dataframes the transform by get_* method.
+'''
+
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(HERE, 'fixtures')
+BASELINE_FILE = os.path.join(FIXTURE_DIR, 'baseline.json')
+
+#name -> (sessions, sections, pairs per section, boards per session) of the synthetic page
+FIXTURES = {
+    'club': (1, 1, 12, 24),
+    'multi_section': (1, 4, 26, 27),
+    'multi_session': (2, 3, 20, 26),
+}
+STAGES = ('extract', 'transform', 'upload')
+#spider method that builds each table as a DataFrame, used with --dataframes
+FRAME_METHODS = {
+    'player_data': 'get_players',
+    'club_data': 'get_club',
+    'game_data': 'get_game_details',
+    'section_data': 'get_section_data',
+    'pair_results_data': 'get_game_results',
+    'hand_results_data': 'get_hand_results',
+    'strat_result_summary_data': 'get_score_summary',
+}
+
+
+def load_scraper():
+    #the scraper file name has a dash so it is loaded by path
+    spec = importlib.util.spec_from_file_location('acbl_live_scraper', os.path.join(HERE, 'acbl-live_scraper.py'))
+    scraper = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(scraper)
+    return scraper
+
+
+def synthetic_game(game_id, sessions, sections, pairs, boards, seed=1):
+    '''A mitchell pairs game in the shape of the website json, every id is unique to the game'''
+    rnd = random.Random(seed)
+    ranks = ['A', 'K', 'Q', 'J', '10', '9', '8', '7', '6', '5', '4', '3', '2']
+    data = {'id': game_id, 'name': 'Benchmark Pairs', 'rating': 1, 'club_id_number': 261750, 'type': 'PAIRS',
+            'board_scoring_method': 'MATCH_POINTS', 'start_date': '10/01/2024', 'end_date': '10/01/2024',
+            'number_of_sessions': sessions,
+            'club': {'id': 261750, 'name': 'Benchmark Club', 'unit_no': 391, 'district_no': 18, 'manager_no': None, 'alias': 'BENCH'},
+            'sessions': []}
+    result_id = game_id * 100000
+    for session_num in range(sessions):
+        session_id = game_id * 10 + session_num
+        hand_records = []
+        for board in range(1, boards + 1):
+            deck = [(suit, rank) for suit in 'SHDC' for rank in range(13)]
+            rnd.shuffle(deck)
+            hand = {'id': session_id * 100 + board, 'board': board, 'dealer': 'NESW'[(board - 1) % 4], 'vulnerability': 'None',
+                    'double_dummy_ew': 'E 6 7 5 8 6 W 6 7 5 8 6', 'double_dummy_ns': 'N 7 6 8 5 7 S 7 6 8 5 7', 'par': 'NS 2H 110'}
+            for seat_num, seat in enumerate(('north', 'east', 'south', 'west')):
+                cards = sorted(deck[seat_num * 13:(seat_num + 1) * 13], key=lambda card: card[1])
+                for suit, suit_name in zip('SHDC', ('spades', 'hearts', 'diamonds', 'clubs')):
+                    hand[f'{seat}_{suit_name}'] = ' '.join(ranks[rank] for card_suit, rank in cards if card_suit == suit)
+            hand_records.append(hand)
+        session = {'id': session_id, 'game_date': '2024-10-01 19:00:00', 'hand_record_id': f'{session_id}',
+                   'number_of_sections': sections, 'hand_records': hand_records, 'sections': []}
+        for section_num in range(sections):
+            section_id = session_id * 10 + section_num
+            tables = pairs // 2
+            pair_summaries = []
+            for direction in ('NS', 'EW'):
+                for pair_num in range(1, tables + 1):
+                    players = []
+                    for seat in range(2):
+                        acbl_num = 1000000 + section_id % 1000 * 100 + pair_num * 4 + (seat if direction == 'NS' else seat + 2)
+                        players.append({'name': f'Player {acbl_num}', 'id_number': acbl_num, 'city': 'Calgary', 'state': 'AB',
+                                        'lifemaster': rnd.choice([0, 1]), 'mp_total': str(rnd.randint(0, 5000)),
+                                        'bbo_username': None, 'awards_score': [{'total': 0.5}] if pair_num == 1 else []})
+                    pair_id = section_id * 100 + len(pair_summaries)
+                    pair_summaries.append({'id': pair_id, 'pair_number': str(pair_num), 'direction': direction,
+                                           'score': rnd.uniform(40, 70), 'percentage': rnd.uniform(40, 70), 'players': players,
+                                           'strat_place': [{'id': pair_id * 10 + strat, 'strat_number': strat, 'rank': pair_num, 'type': 'overall'} for strat in (1, 2)]})
+            board_list = []
+            for board in range(1, boards + 1):
+                results = []
+                for table_num in range(1, tables + 1):
+                    score = rnd.choice(['420', '-50', 'PASS', '110', '-100', '630'])
+                    result_id += 1
+                    results.append({'id': result_id, 'board_id': section_id * 100 + board, 'round_number': (board - 1) // 3 + 1,
+                                    'table_number': table_num, 'ns_pair': str(table_num), 'ew_pair': str((table_num + board) % tables + 1),
+                                    'ns_score': score, 'ew_score': '', 'contract': '4S', 'declarer': 'N',
+                                    'ew_match_points': rnd.uniform(0, tables - 1), 'ns_match_points': rnd.uniform(0, tables - 1),
+                                    'opening_lead': 'HK', 'result': rnd.choice(['=', '+1', '-2']), 'tricks_taken': 10})
+                board_list.append({'id': section_id * 100 + board, 'board_number': board, 'board_results': results})
+            session['sections'].append({'id': section_id, 'session_id': session_id, 'name': 'ABCDEFGH'[section_num], 'boards_per_round': 3,
+                                        'number_of_rounds': boards // 3, 'pair_summaries': pair_summaries, 'boards': board_list})
+        data['sessions'].append(session)
+    return data
+
+
+def load_fixture(name):
+    #a recorded page when there is one, otherwise a synthetic page of the same size
+    path = os.path.join(FIXTURE_DIR, name + '.html')
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            return file.read(), 'recorded'
+    data = synthetic_game(900000 + list(FIXTURES).index(name), *FIXTURES[name])
+    return b'<html><script>var data = ' + json.dumps(data).encode('utf-8') + b';</script></html>', 'synthetic'
+
+
+def record_fixture(name, url):
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    request = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3865.90 Safari/537.36'})
+    with urllib.request.urlopen(request) as response:
+        body = response.read()
+    with open(os.path.join(FIXTURE_DIR, name + '.html'), 'wb') as file:
+        file.write(body)
+    print(f"Recorded {len(body)} bytes as the {name} fixture")
+
+
+def open_scratch_database(scraper, folder):
+    #a fresh sqlite file standing in for mariadb, the archive is off so only the database is measured
+    os.makedirs(os.path.join(folder, 'settings'), exist_ok=True)
+    with open(os.path.join(folder, 'settings', 'db.json'), 'w') as file:
+        json.dump({'system': 'sqlite', 'database': os.path.join(folder, 'bench.db'), 'archive_dir': ''}, file)
+    scraper.player_cache.entries.clear()
+    return scraper.open_database(os.path.join(folder, 'settings', 'db.json'))
+
+
+def ingest(scraper, spider, db, body, dataframes=False):
+    '''One page through every stage, returns ({stage: seconds}, rows written, {part: seconds}) where the parts are
+    the upload of each table and with dataframes the shared normalize_game walk and each get_* method'''
+    times = {}
+    parts = {}
+    start = time.perf_counter()
+    data, payload = scraper.extract_game_data(body)
+    times['extract'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if dataframes:
+        #the get_* methods share one walk of the game, timed on its own so the methods only count their DataFrame
+        spider.normalized(data)
+        parts['transform/normalize_game'] = time.perf_counter() - start
+        frames = {}
+        for table_name, method in list(FRAME_METHODS.items()) + [(None, 'get_hand_records')]:
+            method_start = time.perf_counter()
+            frames[table_name] = getattr(spider, method)(data)
+            parts[f'transform/{method}'] = time.perf_counter() - method_start
+        hands = frames.pop(None)
+        frames['hand_records_data'] = hands['hand_record']
+        frames['hand_possibility_data'] = hands['hand_expect']
+        rows = sum(len(frame) for frame in frames.values())
+    else:
+        tables = scraper.normalize_game(data, deal_format=db.deal_format)
+        rows = sum(len(buffer) for buffer in tables.values())
+    times['transform'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if dataframes:
+        for table_name in scraper.TABLE_COLUMNS:
+            if table_name in frames and len(frames[table_name]):
+                db.upload_df_to_database(frames[table_name], table_name, **scraper.UPLOAD_OPTIONS.get(table_name, {}))
+    elif not db.upload_game(tables):
+        raise RuntimeError('upload_game failed, see the message above')
+    times['upload'] = time.perf_counter() - start
+    #the backend times every table it writes, see StorageBackend.record_upload
+    for key, value in db.take_metrics().items():
+        if key.startswith('acbl/upload_seconds/'):
+            parts['upload/' + key.split('/')[-1]] = value
+    return times, rows, parts
+
+
+def run(rounds=5, dataframes=False):
+    #loaded from inside a scratch folder so anything reading settings/db.json gets the sqlite stand in
+    with tempfile.TemporaryDirectory(prefix='acbl-bench-') as scratch:
+        return run_in(scratch, rounds, dataframes)
+
+
+def run_in(scratch, rounds, dataframes):
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    settings_path = os.path.join(scratch, 'settings', 'db.json')
+    try:
+        os.makedirs(os.path.join(scratch, 'settings'), exist_ok=True)
+        with open(settings_path, 'w') as file:
+            json.dump({'system': 'sqlite', 'database': os.path.join(scratch, 'import.db'), 'archive_dir': ''}, file)
+        scraper = load_scraper()
+        spider = scraper.ACBL_spider()
+        report = {}
+        for name in FIXTURES:
+            body, source = load_fixture(name)
+            #memory is traced on an extra untimed round that also warms up, tracemalloc slows everything down
+            db = open_scratch_database(scraper, os.path.join(scratch, f'{name}-memory'))
+            tracemalloc.start()
+            ingest(scraper, spider, db, body, dataframes)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            db.close()
+            stage_totals = dict.fromkeys(STAGES, 0.0)
+            part_totals = {}
+            rows = 0
+            for round_num in range(rounds):
+                #a new database every round so each game is a fresh insert
+                db = open_scratch_database(scraper, os.path.join(scratch, f'{name}-{round_num}'))
+                times, rows, parts = ingest(scraper, spider, db, body, dataframes)
+                db.close()
+                for stage, seconds in times.items():
+                    stage_totals[stage] += seconds
+                for part, seconds in parts.items():
+                    part_totals[part] = part_totals.get(part, 0.0) + seconds
+            total = sum(stage_totals.values())
+            report[name] = {
+                'source': source,
+                'page_bytes': len(body),
+                'rows': rows,
+                'games_per_sec': rounds / total,
+                'rows_per_sec': rows * rounds / total,
+                'peak_mb': peak / 2 ** 20,
+                'stage_ms': {stage: 1000 * seconds / rounds for stage, seconds in stage_totals.items()},
+                'part_ms': {part: 1000 * seconds / rounds for part, seconds in part_totals.items()},
+            }
+    finally:
+        os.chdir(cwd)
+    return report
+
+
+def print_report(report):
+    print(f"{'fixture':<15}{'source':<11}{'KB':>8}{'rows':>8}{'games/s':>10}{'rows/s':>10}{'peak MB':>9}" + ''.join(f'{stage + " ms":>13}' for stage in STAGES))
+    for name, result in report.items():
+        print(f"{name:<15}{result['source']:<11}{result['page_bytes'] / 1024:>8.0f}{result['rows']:>8}{result['games_per_sec']:>10.2f}"
+              f"{result['rows_per_sec']:>10.0f}{result['peak_mb']:>9.1f}" + ''.join(f"{result['stage_ms'][stage]:>13.1f}" for stage in STAGES))
+    for name, result in report.items():
+        #slowest first within each stage
+        print(f"\n{name} ms")
+        for stage in ('transform', 'upload'):
+            parts = sorted(((part.split('/', 1)[1], ms) for part, ms in result.get('part_ms', {}).items() if part.startswith(stage + '/')),
+                           key=lambda part: -part[1])
+            if parts:
+                print(f"  {stage:<10}" + ', '.join(f'{part} {ms:.2f}' for part, ms in parts))
+    if any(result['source'] == 'synthetic' for result in report.values()):
+        print("\nSynthetic pages were used, their shape is not checked against the site. Record real ones with --record <fixture> <url>")
+
+
+def regressions(report, baseline, threshold):
+    #fixtures whose games/sec fell more than threshold (a fraction) below the baseline
+    slower = []
+    for name, result in report.items():
+        if name in baseline and result['games_per_sec'] < baseline[name]['games_per_sec'] * (1 - threshold):
+            slower.append((name, baseline[name]['games_per_sec'], result['games_per_sec']))
+    return slower
+
+
+if __name__ == "__main__":
+    if '--record' in sys.argv:
+        record_fixture(sys.argv[sys.argv.index('--record') + 1], sys.argv[sys.argv.index('--record') + 2])
+        sys.exit(0)
+    rounds = 5
+    threshold = None
+    if '--rounds' in sys.argv:
+        rounds = int(sys.argv[sys.argv.index('--rounds') + 1])
+    if '--threshold' in sys.argv:
+        threshold = float(sys.argv[sys.argv.index('--threshold') + 1])
+
+    report = run(rounds=rounds, dataframes='--dataframes' in sys.argv)
+    print_report(report)
+
+    if '--save_baseline' in sys.argv:
+        os.makedirs(FIXTURE_DIR, exist_ok=True)
+        with open(BASELINE_FILE, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Saved baseline to {BASELINE_FILE}")
+    if threshold is not None:
+        if not os.path.exists(BASELINE_FILE):
+            #baselines are per machine and not committed, the first run on a fresh checkout becomes the baseline
+            os.makedirs(FIXTURE_DIR, exist_ok=True)
+            with open(BASELINE_FILE, 'w') as file:
+                json.dump(report, file, indent=2)
+            print(f"No baseline yet, saved this run to {BASELINE_FILE} for the next comparison")
+            sys.exit(0)
+        with open(BASELINE_FILE, 'r') as file:
+            slower = regressions(report, json.load(file), threshold)
+        for name, before, after in slower:
+            print(f"REGRESSION {name}: {before:.2f} -> {after:.2f} games/s")
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,224 @@
+'''Helpers for working with bridge deals as numpy arrays, shared by the scraper and the analytics code.
+
+A deal is 52 cards indexed suit * 13 + rank, suits in the order spades, hearts, diamonds, clubs and ranks from the
+ace down to the two. Each card holds the index of the seat that was dealt it (0 N, 1 E, 2 S, 3 W) or -1 when the card
+is missing from the hand record. Stored in the database the same deal is a 52 character string of seat letters
+('-' for a missing card), so a board is one row instead of four.
+
+The double dummy and par strings from the hand records are parsed into numbers here too, double dummy tricks load
+into an (n_boards, 4, 5) array by seat and strain.
+
+hand_features works out high card points, suit lengths, shape and losing trick count for every seat of a batch of deals
+at once, the scraper stores them in hand_feature_data.
+'''
+
+import re
+
+import numpy as np
+
+
+SEATS = 'NESW'
+SUITS = 'SHDC'
+RANKS = 'AKQJT98765432'
+
+#byte value to rank index, anything that is not a card maps to -1
+RANK_LOOKUP = np.full(256, -1, dtype=np.int8)
+for rank_num, rank in enumerate(RANKS):
+    RANK_LOOKUP[ord(rank)] = rank_num
+
+#byte value to seat index for the stored deal strings
+SEAT_LOOKUP = np.full(256, -1, dtype=np.int8)
+for seat_num, seat in enumerate(SEATS):
+    SEAT_LOOKUP[ord(seat)] = seat_num
+
+SEAT_BYTES = np.frombuffer(SEATS.encode('ascii') + b'-', dtype=np.uint8)
+RANK_BYTES = np.frombuffer(RANKS.encode('ascii'), dtype=np.uint8)
+
+
+def encode_deals(suits):
+    '''suits is array like with shape (n_boards, 4, 4) holding the cleaned holding for every seat (NESW) and suit (SHDC),
+    like 'AKT92' with T for the ten and no spaces. Returns an (n_boards, 52) int8 array of seat indexes'''
+    holdings = np.asarray(suits, dtype='S13')
+    n_boards = holdings.shape[0]
+    deals = np.full((n_boards, 52), -1, dtype=np.int8)
+    if n_boards == 0:
+        return deals
+    #(n_boards, seat, suit, card position) rank indexes, padding bytes come back as -1
+    ranks = RANK_LOOKUP[np.ascontiguousarray(holdings).view(np.uint8).reshape(n_boards, 4, 4, 13)]
+    board_idx, seat_idx, suit_idx, card_pos = np.nonzero(ranks >= 0)
+    deals[board_idx, suit_idx * 13 + ranks[board_idx, seat_idx, suit_idx, card_pos]] = seat_idx
+    return deals
+
+
+def decode_deals(deals):
+    '''Inverse of encode_deals, returns an (n_boards, 4, 4) array of holdings strings by seat and suit'''
+    deals = np.asarray(deals, dtype=np.int8)
+    n_boards = deals.shape[0]
+    by_suit = deals.reshape(n_boards, 4, 13)
+    holdings = np.empty((n_boards, 4, 4), dtype=object)
+    for seat_num in range(4):
+        held = by_suit == seat_num
+        #push the held cards to the front of each suit keeping rank order, the zero bytes left over are trimmed by S13
+        order = np.argsort(~held, axis=2, kind='stable')
+        cards = np.where(held, RANK_BYTES, 0).astype(np.uint8)
+        cards = np.take_along_axis(cards, order, axis=2)
+        holdings[:, seat_num, :] = np.ascontiguousarray(cards).view('S13').reshape(n_boards, 4).astype(str)
+    return holdings
+
+
+def deal_strings(deals):
+    '''Turns an (n_boards, 52) seat array into the 52 character strings stored in hand_deal_data'''
+    deals = np.asarray(deals, dtype=np.int8)
+    chars = SEAT_BYTES[np.where(deals < 0, 4, deals)]
+    return np.ascontiguousarray(chars).view('S52').ravel().astype(str)
+
+
+def parse_deal_strings(strings):
+    '''Loads stored 52 character deal strings back into an (n_boards, 52) int8 seat array'''
+    joined = ''.join(strings).encode('ascii')
+    return SEAT_LOOKUP[np.frombuffer(joined, dtype=np.uint8)].reshape(-1, 52)
+
+
+#4 3 2 1 for the ace to the jack of every suit, in deal card order
+HCP_VALUES = np.tile(np.array([4, 3, 2, 1] + [0] * 9, dtype=np.int8), 4)
+SHAPE_CLASSES = ('balanced', 'semi_balanced', 'unbalanced')
+
+
+def suit_lengths(deals):
+    '''(n_boards, 4, 4) number of cards by seat (NESW) and suit (SHDC)'''
+    by_suit = np.asarray(deals, dtype=np.int8).reshape(-1, 1, 4, 13)
+    return (by_suit == np.arange(4, dtype=np.int8).reshape(1, 4, 1, 1)).sum(axis=3).astype(np.int8)
+
+
+def high_card_points(deals):
+    '''(n_boards, 4) high card points by seat'''
+    held = np.asarray(deals, dtype=np.int8)[:, None, :] == np.arange(4, dtype=np.int8).reshape(1, 4, 1)
+    return (held * HCP_VALUES).sum(axis=2).astype(np.int8)
+
+
+def losing_trick_count(deals, lengths=None):
+    '''(n_boards, 4) losing trick count by seat. Every suit has as many losers as its first three cards, less one for
+    each of the ace, king and queen held among them, so Kx is one loser and a singleton queen or Qx still count in full'''
+    deals = np.asarray(deals, dtype=np.int8)
+    if lengths is None:
+        lengths = suit_lengths(deals)
+    counted = np.minimum(lengths, 3)
+    #(n_boards, seat, suit, A K Q) held by the seat
+    honours = deals.reshape(-1, 1, 4, 13)[..., :3] == np.arange(4, dtype=np.int8).reshape(1, 4, 1, 1)
+    #an honour only saves a loser when the suit is long enough for it to be one of the counted cards
+    honours &= np.arange(3).reshape(1, 1, 1, 3) < counted[..., None]
+    return (counted - honours.sum(axis=3)).sum(axis=2).astype(np.int8)
+
+
+def hand_shapes(lengths):
+    '''Shape strings like '5-3-3-2' (longest suit first) and the SHAPE_CLASSES index by seat from suit_lengths.
+    4333, 4432 and 5332 are balanced, 5422 and 6322 semi balanced and the rest unbalanced'''
+    ordered = -np.sort(-np.asarray(lengths), axis=2)
+    parts = ordered.astype(str)
+    shapes = parts[..., 0]
+    for suit_num in range(1, 4):
+        shapes = np.char.add(np.char.add(shapes, '-'), parts[..., suit_num])
+    doubletons = (ordered == 2).sum(axis=2)
+    longest = ordered[..., 0]
+    shortest = ordered[..., 3]
+    balanced = (shortest >= 2) & (longest <= 5) & (doubletons <= 1)
+    semi_balanced = ~balanced & (shortest >= 2) & (longest <= 6)
+    classes = np.where(balanced, 0, np.where(semi_balanced, 1, 2)).astype(np.int8)
+    return shapes, classes
+
+
+def hand_features(deals):
+    '''Features of every seat for a batch of (n_boards, 52) deals, a dict of arrays shaped (n_boards, 4) by seat
+    except lengths which is (n_boards, 4, 4) by seat and suit. side_hcp and side_ltc are the partnership totals,
+    NS for north and south and EW for east and west. complete is False for a seat without all 13 cards'''
+    lengths = suit_lengths(deals)
+    hcp = high_card_points(deals)
+    ltc = losing_trick_count(deals, lengths)
+    shapes, classes = hand_shapes(lengths)
+    #seat 0 plays with seat 2 and 1 with 3
+    partner = np.array([2, 3, 0, 1])
+    return {
+        'hcp': hcp,
+        'lengths': lengths,
+        'shape': shapes,
+        'shape_class': classes,
+        'ltc': ltc,
+        'side_hcp': hcp + hcp[:, partner],
+        'side_ltc': ltc + ltc[:, partner],
+        'complete': lengths.sum(axis=2) == 13,
+    }
+
+
+STRAINS = 'CDHSN'
+#strain symbols and names as they show up in hand records, all mapped to a letter of STRAINS
+STRAIN_NAMES = {'C': 'C', 'D': 'D', 'H': 'H', 'S': 'S', 'N': 'N', 'NT': 'N', '♣': 'C', '♦': 'D', '♥': 'H', '♠': 'S'}
+DD_COLUMNS = tuple(f'dd_{seat.lower()}_{strain.lower() if strain != "N" else "nt"}' for seat in SEATS for strain in STRAINS)
+PAR_COLUMNS = ('par_level', 'par_strain', 'par_doubled', 'par_declarer', 'par_score')
+
+SEAT_GROUP = re.compile(r'([NSEW])\s*[:=-]?\s*((?:\d{1,2}[\s,/-]*){5})')
+NUMBER = re.compile(r'\d{1,2}')
+PAR_CONTRACT = re.compile(r'([1-7])\s*(NT|♠|♥|♦|♣|[CDHSN])\s*(xx|XX|x|X|\*\*|\*)?')
+PAR_DECLARER = re.compile(r'(?<![A-Za-z])(NS|EW|N|S|E|W)(?![A-Za-z])')
+PAR_SCORE = re.compile(r'(?<![\d])([+-]?\d{2,5})(?!\s*(?:NT|[CDHSN♠♥♦♣]))')
+
+
+def parse_double_dummy_side(text, side):
+    '''Tricks for the two seats of one side from a double dummy string, {seat: [c, d, h, s, nt]}.
+    Seat tagged groups of five numbers are read as tricks in club, diamond, heart, spade, notrump order, five numbers
+    with no seat apply to both seats of the side and ten numbers are the two seats in order'''
+    tricks = {}
+    if not text:
+        return tricks
+    groups = SEAT_GROUP.findall(text)
+    if groups:
+        for seat, numbers in groups:
+            if seat in side:
+                tricks[seat] = [int(number) for number in NUMBER.findall(numbers)]
+    else:
+        numbers = [int(number) for number in NUMBER.findall(text)]
+        if len(numbers) == 5:
+            tricks = {side[0]: numbers, side[1]: numbers}
+        elif len(numbers) == 10:
+            tricks = {side[0]: numbers[:5], side[1]: numbers[5:]}
+    return {seat: values for seat, values in tricks.items() if all(0 <= value <= 13 for value in values)}
+
+
+def parse_double_dummy(double_dummy_ns, double_dummy_ew):
+    '''The 20 DD_COLUMNS values (seat NESW by strain CDHSN) parsed from the two hand record strings, None where unknown'''
+    tricks = parse_double_dummy_side(double_dummy_ns, 'NS')
+    tricks.update(parse_double_dummy_side(double_dummy_ew, 'EW'))
+    values = []
+    for seat in SEATS:
+        values += tricks.get(seat, [None] * 5)
+    return values
+
+
+def parse_par(par):
+    '''(level, strain, doubled, declarer, score) from a par string like "NS 4S 420" or "EW 3NTx-2 +500", None where unknown'''
+    if not par:
+        return (None, None, None, None, None)
+    level = strain = doubled = declarer = score = None
+    contract = PAR_CONTRACT.search(par)
+    if contract:
+        level = int(contract.group(1))
+        strain = STRAIN_NAMES[contract.group(2)]
+        doubled = (contract.group(3) or '').upper().replace('*', 'X') or None
+    seat = PAR_DECLARER.search(PAR_CONTRACT.sub(' ', par))
+    if seat:
+        declarer = seat.group(1)
+    scores = PAR_SCORE.findall(PAR_CONTRACT.sub(' ', par))
+    if scores:
+        score = int(scores[-1])
+    return (level, strain, doubled, declarer, score)
+
+
+def double_dummy_array(rows):
+    '''rows of the 20 DD_COLUMNS values into an (n_boards, 4, 5) int8 array by seat (NESW) and strain (CDHSN), -1 when unknown'''
+    values = np.array(rows, dtype=object).reshape(-1, 20)
+    tricks = np.where(is_missing(values), -1, values).astype(np.int8)
+    return tricks.reshape(-1, 4, 5)
+
+
+def is_missing(values):
+    #None and NaN both count as missing
+    return np.frompyfunc(lambda value: value is None or value != value, 1, 1)(values).astype(bool)